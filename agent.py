@@ -9,6 +9,7 @@ class Agent(object):
     def __init__(self, env=None):
         self.env = env
         self.policy = None
+        self.constant = False   # whether the agent always gives the same action
 
     def reset(self):
         raise NotImplementedError('Please implement nextAction function.')
@@ -25,9 +26,37 @@ class Agent(object):
     def setPolicy(self, policy=None):
         raise NotImplementedError('Please implement nextAction function.')
 
+    def getConfig(self):
+        # return : the settings of the agent, restored with setConfig
+        return {}
+
+    def setConfig(self, config):
+        pass
+
+    def getState(self):
+        # return : the internal state of the agent, restored with setState
+        return {}
+
+    def setState(self, state):
+        pass
+
     def nextAction(self):
         raise NotImplementedError('Please implement nextAction function.')
 
+    def nextActions(self, policies, model=None):
+        # input: policies: [nBatch x ne] one policy per copy of a BatchedModel
+        #        model: the BatchedModel, the model of the env by default
+        # return : the next actions of all the copies [nBatch x ne]
+        raise NotImplementedError('Please implement nextActions function.')
+
+    def getSchedule(self, nSteps, policies=None, model=None):
+        # compile the next nSteps actions into segments of constant actions, the agent advances as if it had given
+        # them one by one, see Env.rollout
+        # input: policies, model: check nextActions, if policies is None, the actions of nextAction
+        # return : list of (number of steps, action), None if the actions cannot be compiled, they are then given
+        #          step by step
+        return None
+
 
 class AgentBinary(Agent):
     # The agent that switches ON / OFF of the trussbot
@@ -49,23 +78,76 @@ class AgentBinary(Agent):
 
     def load(self, policyName):
         super().load(policyName)
+        self.policy = np.asarray(self.policy, dtype=self.env.model.dtype)
         assert(self.env.model.actionSpace.contains(self.policy))
         self.actionOn = self.policy
 
     def setPolicy(self, policy=None):
+        policy = np.asarray(policy, dtype=self.env.model.dtype)    # e.g. a float64 gene of the optimizer
         assert(self.env.model.actionSpace.contains(policy))
         self.policy = policy
         self.actionOn = self.policy
 
-    def nextAction(self):
-        n = self.nSteps % (self.nStepsOn + self.nStepsOff)
+    def getConfig(self):
+        return {'nStepsOn': self.nStepsOn, 'nStepsOff': self.nStepsOff}
+
+    def setConfig(self, config):
+        self.nStepsOn = config['nStepsOn']
+        self.nStepsOff = config['nStepsOff']
+
+    def getState(self):
+        return {'nSteps': self.nSteps, 'actionOn': self.actionOn}
+
+    def setState(self, state):
+        self.nSteps = state['nSteps']
+        self.actionOn = state['actionOn']
+
+    def isOn(self, model):
+        # return : whether the next step is actuated
+        # with adaptive step sizes the periods are timed by the simulated time, in steps of the reference size
+        if model.adaptive:
+            n = int(model.time / model.hRef + 1e-6) % (self.nStepsOn + self.nStepsOff)
+        else:
+            n = self.nSteps % (self.nStepsOn + self.nStepsOff)
         self.nSteps += 1
+        return n < self.nStepsOn
 
-        if n < self.nStepsOn:
+    def nextAction(self):
+        if self.isOn(self.env.model):
             return self.actionOn
         else:
             return self.actionOff
 
+    def nextActions(self, policies, model=None):
+        if self.isOn(self.env.model if model is None else model):
+            return policies
+        else:
+            return np.broadcast_to(self.actionOff, policies.shape)
+
+    def getSchedule(self, nSteps, policies=None, model=None):
+        # alternate segments of nStepsOn and nStepsOff steps, from the current phase
+        # with adaptive step sizes, the periods are timed by the simulated time and cannot be compiled
+        if (self.env.model if model is None else model).adaptive:
+            return None
+        actionOn = self.actionOn if policies is None else policies
+        actionOff = self.actionOff if policies is None else np.broadcast_to(self.actionOff, policies.shape)
+        period = self.nStepsOn + self.nStepsOff
+
+        schedule = []
+        i = 0
+        n = self.nSteps % period    # phase of the next step
+        while i < nSteps:
+            if n < self.nStepsOn:
+                nSegment = min(self.nStepsOn - n, nSteps - i)
+                schedule.append((nSegment, actionOn))
+            else:
+                nSegment = min(period - n, nSteps - i)
+                schedule.append((nSegment, actionOff))
+            i += nSegment
+            n = (n + nSegment) % period
+        self.nSteps += nSteps
+        return schedule
+
 
 class AgentActuate(Agent):
     # The agent that actuates the trussbot once, for shape approximation
@@ -73,19 +155,34 @@ class AgentActuate(Agent):
     def __init__(self, env=None):
         super().__init__(env)
         self.actionOn = None        # the shrinkage ratio when actuated
+        self.constant = True
 
     def reset(self):
         self.actionOn = self.env.model.actionSpace.high
 
     def load(self, policyName):
         super().load(policyName)
+        self.policy = np.asarray(self.policy, dtype=self.env.model.dtype)
         assert(self.env.model.actionSpace.contains(self.policy))
         self.actionOn = self.policy
 
     def setPolicy(self, policy=None):
+        policy = np.asarray(policy, dtype=self.env.model.dtype)
         assert (self.env.model.actionSpace.contains(policy))
         self.policy = policy
         self.actionOn = self.policy
 
+    def getState(self):
+        return {'actionOn': self.actionOn}
+
+    def setState(self, state):
+        self.actionOn = state['actionOn']
+
     def nextAction(self):
         return self.actionOn
+
+    def nextActions(self, policies, model=None):
+        return policies
+
+    def getSchedule(self, nSteps, policies=None, model=None):
+        return [(nSteps, self.actionOn if policies is None else policies)]
@@ -0,0 +1,98 @@
+import os
+import json
+import hashlib
+import sqlite3
+from collections import OrderedDict
+import numpy as np
+
+
+class FitnessCache(object):
+    # cache of the fitnesses of genes, the simulation is deterministic so a gene is only simulated once
+    # the key of a gene hashes the model geometry, the settings of the env (model constants, time step, agent,
+    # criterion and its parameters) and the bytes of the gene
+    # an LRU dict in memory, optionally backed by an sqlite file that survives across runs
+
+    def __init__(self, maxSize=100000, path=None):
+        # input: maxSize: max number of fitnesses kept in memory
+        #        path: the sqlite file of the cache on disk, None: memory only
+        self.maxSize = maxSize
+        self.path = path
+        self.memory = OrderedDict()     # key: fitness
+        self.db = None
+        self.context = None             # hash of everything but the gene
+
+        self.nHits = 0                  # hits in the last lookup
+        self.nLookups = 0
+        self.nHitsTotal = 0
+        self.nLookupsTotal = 0
+
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS fitness (key TEXT PRIMARY KEY, fit REAL)')
+
+    def setContext(self, env):
+        # hash the model geometry and the settings of the env the genes are evaluated with
+        config = env.getConfig()
+        config.pop('profile')       # profiling does not change the fitnesses
+        config['model'].pop('v')    # the geometry is hashed by getHash
+        config['model'].pop('e')
+        config = json.dumps(config, sort_keys=True, default=lambda x: np.asarray(x).tolist())
+        h = hashlib.sha1(env.model.getHash().encode())
+        h.update(config.encode())
+        self.context = h.digest()
+
+    def keys(self, pop):
+        # input: pop: [n x len(lb)] genes in float
+        # return : list of the keys of the genes
+        keys = []
+        for gene in pop:
+            h = hashlib.sha1(self.context)
+            h.update(np.ascontiguousarray(gene, dtype=np.float64).tobytes())
+            keys.append(h.hexdigest())
+        return keys
+
+    def get(self, keys):
+        # return : list of the cached fitnesses, None for misses
+        fits = []
+        for key in keys:
+            fit = self.memory.get(key)
+            if fit is not None:
+                self.memory.move_to_end(key)
+            elif self.db is not None:
+                row = self.db.execute('SELECT fit FROM fitness WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    fit = row[0]
+                    self.remember(key, fit)
+            fits.append(fit)
+
+        self.nLookups = len(keys)
+        self.nHits = sum(fit is not None for fit in fits)
+        self.nLookupsTotal += self.nLookups
+        self.nHitsTotal += self.nHits
+        return fits
+
+    def set(self, keys, fits):
+        for key, fit in zip(keys, fits):
+            self.remember(key, float(fit))
+        if self.db is not None:
+            self.db.executemany('INSERT OR REPLACE INTO fitness VALUES (?, ?)', zip(keys, map(float, fits)))
+            self.db.commit()
+
+    def remember(self, key, fit):
+        self.memory[key] = fit
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxSize:
+            self.memory.popitem(last=False)
+
+    def hitRate(self, total=False):
+        # return : the hit rate of the last lookup, or of all the lookups so far
+        if total:
+            return self.nHitsTotal / max(self.nLookupsTotal, 1)
+        return self.nHits / max(self.nLookups, 1)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
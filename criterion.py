@@ -1,18 +1,222 @@
 import os
 import numpy as np
-import trimesh
+from model import BatchedModel
+from target import DistanceField, ParametricTarget, TargetCylinder
 rootPath = os.path.split(os.path.realpath(__file__))[0]
 
 
+def mergeStats(statsList):
+    # return : the sum of the stats dicts of several criteria, e.g. of the worker processes
+    merged = {}
+    for stats in statsList:
+        for k, x in stats.items():
+            if k not in merged:
+                merged[k] = x
+            elif isinstance(x, dict):
+                merged[k] = mergeStats([merged[k], x])
+            else:
+                merged[k] = merged[k] + x
+    return merged
+
+
+class RolloutMonitor(object):
+    # checks a rollout every nInterval steps, so that it can stop early
+    # a rollout diverges when the positions or the velocities are non-finite, the positions exceed vMax or the
+    # kinetic energy of the vertices exceeds energyMax, a few orders of magnitude above that of the example tasks
+    # a rollout converges when no vertex moved faster than velTolerance since the last check,
+    # only checked if steady is set, i.e. when the action of the agent does not change
+    # for a BatchedModel the flags are kept per copy and the rollout stops when all the copies are done; the copies
+    # that converged keep stepping with the others, so their positions and velocities at convergence are saved and
+    # restored by restore at the end of the rollout, the scores do not depend on the other copies of the batch
+
+    def __init__(self, nInterval=20, vMax=1e3, velTolerance=1e-3, energyMax=1e6):
+        self.nInterval = nInterval
+        self.vMax = vMax
+        self.velTolerance = velTolerance
+        self.energyMax = energyMax
+
+        self.steady = False
+        self.vLast = None       # positions at the last check
+        self.tLast = None       # time at the last check
+        self.diverged = None    # bool [] or [nBatch]
+        self.converged = None
+        self.vConverged = None  # positions of the copies when they converged, [nBatch x nv x 3]
+        self.velConverged = None
+
+    def getConfig(self):
+        # return : the settings of the monitor, a RolloutMonitor(**config) checks the rollouts the same way
+        return {'nInterval': self.nInterval, 'vMax': self.vMax, 'velTolerance': self.velTolerance,
+                'energyMax': self.energyMax}
+
+    def reset(self, model, steady=False):
+        self.steady = steady
+        self.vLast = np.copy(model.v)
+        self.tLast = model.time
+        self.diverged = np.zeros(model.v.shape[:-2], dtype=bool)
+        self.converged = np.zeros(model.v.shape[:-2], dtype=bool)
+        self.vConverged = None
+        self.velConverged = None
+
+    def check(self, model, i, force=False):
+        # input: i: number of steps done, the model is only checked every nInterval steps unless force is set
+        # return : whether the rollout can stop
+        if not force and (i == 0 or i % self.nInterval != 0):
+            return False
+
+        v, vel = model.v, model.vel
+        finite = np.isfinite(v).all((-2, -1)) & np.isfinite(vel).all((-2, -1))
+        with np.errstate(invalid='ignore', over='ignore'):
+            energy = 0.5 * model.m * np.sum(vel ** 2, (-2, -1))
+            diverged = np.invert(finite) | (np.abs(v).max((-2, -1)) > self.vMax) | (energy > self.energyMax)
+            self.diverged |= diverged & np.invert(self.converged)
+
+        if self.steady and model.time > self.tLast:
+            # model.vel keeps the velocity of the vertices pinned by the ground, so the rest is measured on v
+            with np.errstate(invalid='ignore', over='ignore'):
+                rate = np.max(np.abs(v - self.vLast), (-2, -1)) / (model.time - self.tLast)
+            converged = (rate < self.velTolerance) & np.invert(self.converged | self.diverged)
+            if v.ndim > 2 and np.any(converged):
+                if self.vConverged is None:
+                    self.vConverged = np.zeros_like(v)
+                    self.velConverged = np.zeros_like(vel)
+                self.vConverged[converged] = v[converged]
+                self.velConverged[converged] = vel[converged]
+            self.converged |= converged
+            self.vLast = np.copy(v)
+            self.tLast = model.time
+
+        return bool(np.all(self.diverged | self.converged))
+
+    def restore(self, model):
+        # set the copies of a BatchedModel that converged back to their state at convergence
+        if self.vConverged is not None:
+            model.v[self.converged] = self.vConverged[self.converged]
+            model.vel[self.converged] = self.velConverged[self.converged]
+
+
 class Criterion(object):
     # the superclass of the criterion function for evaluating the performance of the agent
 
     def __init__(self, env=None):
         self.env = env
+        self.nSteps = None
+        self.duration = None    # if set, rollouts run for this simulated time in seconds instead of nSteps steps
+
+        self.monitor = RolloutMonitor()     # stops diverged or converged rollouts early, None: run to the end
+        self.steady = False                 # if True, rollouts of constant actions stop once the model is at rest
+        self.worstScore = -np.inf           # score of a diverged rollout
+        self.stats = None                   # counters of the rollouts, see popStats
+        self.popStats()
 
     def __call__(self, x):
         raise NotImplementedError('Please define a reward function.')
 
+    def getConfig(self):
+        # return : the settings of the criterion, restored with setConfig
+        #          the settings of the rollouts are included, early stops change the final states and the scores
+        return {
+            'nSteps': self.nSteps,
+            'duration': self.duration,
+            'monitor': None if self.monitor is None else self.monitor.getConfig(),
+            'steady': self.steady,
+            'worstScore': float(self.worstScore)
+        }
+
+    def setConfig(self, config):
+        self.nSteps = config['nSteps']
+        self.duration = config['duration']
+        self.monitor = None if config['monitor'] is None else RolloutMonitor(**config['monitor'])
+        self.steady = config['steady']
+        self.worstScore = config['worstScore']
+
+    def popStats(self):
+        # return : the counters of the rollouts since the last call, which are then cleared
+        stats = self.stats
+        self.stats = {'nRollouts': 0, 'nSteps': 0, 'nStepsSaved': 0, 'nDiverged': 0, 'nConverged': 0}
+        if stats is not None and self.env.profiler is not None:
+            stats['profile'] = self.env.profiler.popReport()
+        return stats
+
+    def startRollout(self, model):
+        if self.monitor is not None:
+            self.monitor.reset(model, self.steady and self.env.agent.constant)
+
+    def isRunning(self, model, i):
+        # return : whether a rollout continues after i steps of the model
+        if self.duration is None:
+            running = i < self.nSteps
+        else:
+            running = model.time < self.duration
+
+        if self.monitor is not None:
+            if running:
+                running = not self.monitor.check(model, i)
+            else:
+                self.monitor.check(model, i, force=True)
+            if not running:
+                self.monitor.restore(model)
+
+        if not running:
+            nCopies = int(np.prod(model.v.shape[:-2]))
+            if self.duration is None:
+                nStepsLeft = self.nSteps - i
+            else:
+                nStepsLeft = max(int(np.ceil((self.duration - model.time) / model.h)), 0)
+            self.stats['nRollouts'] += nCopies
+            self.stats['nSteps'] += i * nCopies
+            self.stats['nStepsSaved'] += nStepsLeft * nCopies
+            if self.monitor is not None:
+                self.stats['nDiverged'] += int(np.sum(self.monitor.diverged))
+                self.stats['nConverged'] += int(np.sum(self.monitor.converged & np.invert(self.monitor.diverged)))
+        return running
+
+    def getDiverged(self):
+        # return : whether the last rollout diverged, bool [] or [nBatch] for a batched rollout
+        if self.monitor is None:
+            return np.zeros([], dtype=bool)
+        return self.monitor.diverged
+
+    def simulate(self):
+        # run the agent on the env model
+        self.startRollout(self.env.model)
+        self.env.rollout(nSteps=self.getNSteps(), isRunning=self.isRunning, nInterval=self.getNInterval())
+
+    def getNSteps(self):
+        # return : the number of steps of a rollout, None if it runs for a duration
+        return self.nSteps if self.duration is None else None
+
+    def getNInterval(self):
+        # return : the number of steps between two calls of isRunning during a rollout
+        return self.monitor.nInterval if self.monitor is not None else None
+
+    def batch(self, xs):
+        # evaluate a population at once, in one batched rollout if the criterion defines getScores
+        # a BatchedModel shares the step size among the copies, so with adaptive stepping the policies are simulated
+        # one after the other, and the score of a policy does not depend on the others of the population
+        # input: xs: [nBatch x ne] policies
+        # return : scores [nBatch]
+        if self.env.model.adaptive or type(self).getScores is Criterion.getScores:
+            return np.array([self(x) for x in xs])
+        model = self.rolloutBatch(xs)
+        scores = self.getScores(model)
+        scores[self.getDiverged()] = self.worstScore
+        return scores
+
+    def getScores(self, model):
+        # input: model: a BatchedModel, e.g. after rolloutBatch
+        # return : scores [nBatch] of the current states of the copies, diverged copies are not checked,
+        #          also the potential of the rewards of the vector env, see vectorEnv
+        raise NotImplementedError('Please define the scores of a batched model.')
+
+    def rolloutBatch(self, xs):
+        # simulate all the policies in xs together in one BatchedModel
+        # the env model is only reset, the returned BatchedModel holds the final states
+        self.env.reset()
+        model = BatchedModel(self.env.model, len(xs))
+        self.startRollout(model)
+        self.env.rollout(xs, self.getNSteps(), model, self.isRunning, self.getNInterval())
+        return model
+
 
 class CriterionMoveForward(Criterion):
     # the criterion is to move forward along x as fast as possible and do not deviate along y axis
@@ -25,9 +229,9 @@ class CriterionMoveForward(Criterion):
         self.env.reset()
         self.env.agent.setPolicy(x)
         c0 = self.env.model.getCentroid()
-        for i in range(self.nSteps):
-            action = self.env.getAction()
-            self.env.step(action)
+        self.simulate()
+        if self.getDiverged():
+            return self.worstScore
         c1 = self.env.model.getCentroid()
 
         dx = c1[0] - c0[0]
@@ -39,6 +243,14 @@ class CriterionMoveForward(Criterion):
 
         return score
 
+    def getScores(self, model):
+        c0 = np.mean(self.env.model.snapshot['v'], 0)   # centroid at the reset state
+        c1 = model.getCentroid()                        # [nBatch x 3]
+
+        dx = c1[:, 0] - c0[0]
+        dy = np.abs(c1[:, 1] - c0[1])
+        return dx * 5 - dy
+
 
 class CriterionShape(Criterion):
     # the criterion is to minimize the different between a shape and a target shape
@@ -46,73 +258,95 @@ class CriterionShape(Criterion):
     def __init__(self, model, targetName="snake"):
         super().__init__(model)
         self.nSteps = 1000
+        self.steady = True
 
         self.targetName = targetName
-        self.targetMesh = None
+        self.target = None      # distance field of the target mesh, see target.DistanceField
 
     def __call__(self, x):
-        if self.targetMesh is None:
+        if self.target is None:
             self.setTarget(self.targetName)
 
         self.env.reset()
         self.env.agent.setPolicy(x)
-        for i in range(self.nSteps):
-            action = self.env.getAction()
-            self.env.step(action)
+        self.simulate()
+        if self.getDiverged():
+            return self.worstScore
 
-        (closest_points, distances, triangle_id) = self.targetMesh.nearest.on_surface(self.env.model.v)
+        distances = self.target(self.env.model.v)
         distanceMean = np.mean(np.power(distances, 2), axis=0)
         return -distanceMean
 
+    def getScores(self, model):
+        if self.target is None:
+            self.setTarget(self.targetName)
+
+        v = np.where(np.isfinite(model.v), model.v, 0)     # non-finite positions cannot be looked up
+        distances = self.target(v)      # [nBatch x nv]
+        distanceMean = np.mean(np.power(distances, 2), axis=1)
+        return -distanceMean
+
+    def getConfig(self):
+        # the distance field is built here if needed, so that the worker processes only map the saved one
+        if self.target is None:
+            self.setTarget(self.targetName)
+        config = super().getConfig()
+        config['targetName'] = self.targetName
+        return config
+
+    def setConfig(self, config):
+        super().setConfig(config)
+        self.targetName = config['targetName']
+        self.target = None
+
     def setTarget(self, targetName):
-        name = os.path.join(rootPath, "data/target/", targetName+".obj")
+        self.targetName = targetName
         try:
-            self.targetMesh = trimesh.load(name)
-        except:
+            self.target = DistanceField.load(targetName)
+        except IOError:
             print('No such target.')
 
 
 class CriterionCurvedSheet(Criterion):
-    # the criterion is to minimize the difference between the 8x8x1 model and a curved sheet math function
-    R = 3
+    # the criterion is to minimize the difference between the model and a parametric target shape,
+    # by default the 8x8x1 model bent around a cylinder of radius 3
 
-    def __init__(self, model):
+    def __init__(self, model, target=None):
         super().__init__(model)
         self.nSteps = 1000
-        self.targetV = self.convertToTarget()
-
-    def convertToTarget(self):
-        print('The model is reset in CriterionBendingSheet.')
-        self.env.model.reset()
-        vs = self.env.model.v
-
-        R = CriterionCurvedSheet.R
-        d = -0.6
-        ps = []
-        for v in vs:
-            x, y, z = v
-            alpha = (x - 4) / R
-            xx = 4 + R * np.sin(alpha)
-            zz = R + d - R * np.cos(alpha)
-            if z == 1:
-                vec = np.array([4 - xx, 0, R + d - zz])
-                vec = vec / np.sqrt(np.sum(vec ** 2))
-                xx = xx + vec[0]
-                zz = zz + vec[2]
-            ps.append(np.array([xx, y, zz]))
-        ps = np.array(ps)
-        ps = ps.reshape(-1, 3)
-        return ps
+        self.steady = True
+        self.target = TargetCylinder(R=3, d=-0.6) if target is None else target
+
+    def getConfig(self):
+        config = super().getConfig()
+        config['target'] = self.target.getConfig()
+        return config
+
+    def setConfig(self, config):
+        super().setConfig(config)
+        self.target = ParametricTarget.fromConfig(config['target'])
+
+    def setTarget(self, target):
+        # input: target: a ParametricTarget, e.g. TargetSphereCap(R=5)
+        self.target = target
+
+    def getTargetV(self):
+        # return : [nv x 3] target positions, computed once per model geometry and target parameters
+        return self.target.getPositions(self.env.model)
 
     def __call__(self, x):
         self.env.reset()
         self.env.agent.setPolicy(x)
-        for i in range(self.nSteps):
-            action = self.env.getAction()
-            self.env.step(action)
+        self.simulate()
+        if self.getDiverged():
+            return self.worstScore
 
-        assert(self.targetV.shape[1] == 3)
-        assert(self.env.model.v.shape[1] == 3)
-        squaredDistance = np.sum((self.targetV - self.env.model.v) ** 2, axis=1)
+        squaredDistance = np.sum((self.getTargetV() - self.env.model.v) ** 2, axis=1)
         meanSquareDistance = np.mean(squaredDistance)
         return -meanSquareDistance
+
+    def getScores(self, model):
+        with np.errstate(invalid='ignore', over='ignore'):
+            squaredDistance = np.sum((self.getTargetV() - model.v) ** 2, axis=2)
+        meanSquareDistance = np.mean(squaredDistance, axis=1)
+        return -meanSquareDistance
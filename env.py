@@ -1,26 +1,34 @@
 import gym
 
 from model import Model
-from viewer import Viewer
 from agent import AgentBinary, AgentActuate
 from criterion import CriterionMoveForward, CriterionShape, CriterionCurvedSheet
-from optimizer import EvolutionAlgorithm
+from optimizer import EvolutionAlgorithm, CMAES
 
 
 class Env(gym.Env):
     # environment class that wraps all the components
-    # including simulation model, agent, criterion function and optimizer(evolution)
+    # including simulation model, agent, criterion function and optimizer(evolution or cma-es)
 
-    def __init__(self, modelName='tet', agentName='binary', criterionName='moveForward', timeStep=None):
+    def __init__(self, modelName='tet', agentName='binary', criterionName='moveForward', timeStep=None,
+                 backend=None, v=None, e=None, precision='float64', optimizerName='evolution'):
         # input:    modelName: file name of the geometry model, under ./data/model
         #           agentName: label of the control agent, check the dict in Env.setAgent()
         #           criterionName: label of the criterion function, check the dict in Env.setCriterion
         #           timeStep: simulation timeSteps, if the model blows up, decrease this value
+        #           backend: label of the stepping kernel, check the dict in Model.setBackend()
+        #           v, e: geometry of the model instead of the file, e.g. built by generator.py
+        #           precision: 'float64' or 'float32', the dtype of the simulation, check Model.__init__
+        #           optimizerName: label of the optimizer, check the dict in Env.setOptimizer
 
-        self.model = Model(modelName)                       # simulation model
+        self.agentName = agentName
+        self.criterionName = criterionName
+        self.profiler = None    # if set, a Profiler timing the steps of the env, see setProfiler
+
+        self.model = Model(modelName, backend, v, e, precision)  # simulation model
         self.agent = self.setAgent(agentName)               # agent controlling the model(contraction ratio)
         self.criterion = self.setCriterion(criterionName)   # criterion function to evaluate the agent
-        self.optimizer = EvolutionAlgorithm(self)           # evolution optimizer to optimize the agent
+        self.optimizer = self.setOptimizer(optimizerName)   # optimizer of the agent
 
         # initial setting
         self.model.rough()              # set the ground to be non-directionally rough
@@ -35,6 +43,7 @@ class Env(gym.Env):
             'actuate': AgentActuate
         }
         assert(agentName in agentDict)
+        self.agentName = agentName
         self.agent = agentDict[agentName](self)
         return self.agent
 
@@ -45,9 +54,19 @@ class Env(gym.Env):
             'curvedSheet': CriterionCurvedSheet
         }
         assert(criterionName in criterionDict)
+        self.criterionName = criterionName
         self.criterion = criterionDict[criterionName](self)
         return self.criterion
 
+    def setOptimizer(self, optimizerName="evolution"):
+        optimizerDict = {
+            'evolution': EvolutionAlgorithm,
+            'cmaes': CMAES
+        }
+        assert(optimizerName in optimizerDict)
+        self.optimizer = optimizerDict[optimizerName](self)
+        return self.optimizer
+
     def getAction(self):
         return self.agent.nextAction()
 
@@ -56,8 +75,60 @@ class Env(gym.Env):
             self.model.setShrinkage(action)
         self.model.step()
 
+    def rollout(self, policy=None, nSteps=None, model=None, isRunning=None, nInterval=None):
+        # run the agent for nSteps steps, compiled into segments of constant actions by Agent.getSchedule, the
+        # actions are checked once and each segment runs as multi-step calls of the model, which compute the target
+        # lengths once per call; agents without a schedule give their actions step by step
+        # input: policy: set on the agent if given; for a BatchedModel, the [nBatch x ne] policies of the copies
+        #        nSteps: number of steps, if None, the rollout runs step by step until isRunning stops it
+        #        model: the model stepped, the env model by default, or a BatchedModel
+        #        isRunning: if set, function(model, i) called after i steps, every nInterval steps, at the ends of
+        #                   the segments and at the end, the rollout stops when it returns False,
+        #                   e.g. Criterion.isRunning
+        # return : the number of steps done
+        batched = model is not None
+        model = self.model if model is None else model
+        if policy is not None and not batched:
+            self.agent.setPolicy(policy)
+        if isRunning is None:
+            if nSteps is None:
+                raise ValueError('Env.rollout needs nSteps or isRunning to know when to stop')
+            isRunning = lambda model, i: i < nSteps
+
+        schedule = None
+        if nSteps is not None:
+            schedule = self.agent.getSchedule(nSteps, policy if batched else None, model if batched else None)
+        if schedule is None:
+            i = 0
+            while isRunning(model, i):
+                if batched:
+                    model.setShrinkage(self.agent.nextActions(policy, model))
+                    model.step()
+                else:
+                    self.step(self.getAction())
+                i += 1
+            return i
+
+        nInterval = nSteps if nInterval is None else nInterval
+        checked = set()     # ids of the actions checked against the action space
+        i = 0
+        if not isRunning(model, i):
+            return i
+        for nSegment, action in schedule:
+            model.setShrinkage(action, check=id(action) not in checked)
+            checked.add(id(action))
+            while nSegment > 0:
+                n = min(nSegment, nInterval - i % nInterval)
+                model.step(n)
+                i += n
+                nSegment -= n
+                if not isRunning(model, i):
+                    return i
+        return i
+
     def render(self, mode='human', actor=None):
         # visualize the current step of the simulation
+        from viewer import Viewer   # imported here so that headless processes do not need open3d
         viewer = Viewer(self)
         viewer.reset()
         viewer.drawAll()
@@ -65,18 +136,104 @@ class Env(gym.Env):
         viewer.registerKeyCallback()
         viewer.run()
 
-    def run(self):
+    def run(self, speed=1.0, nSubsteps=None, threaded=False):
         # visualize the simulation dynamically
-        viewer = Viewer(self)
+        # input: check Viewer.__init__
+        from viewer import Viewer
+        viewer = Viewer(self, speed=speed, nSubsteps=nSubsteps, threaded=threaded)
         viewer.reset()
         viewer.drawAll()
         viewer.registerAnimationCallback()
         viewer.registerKeyCallback()
         viewer.run()
 
+    def replay(self, path, speed=1.0):
+        # visualize a recorded trajectory without simulating, see Env.record
+        # input: speed: ratio of the playback speed to the simulated time
+        from viewer import Viewer
+        from recorder import Recording
+        viewer = Viewer(self, Recording(path), speed)
+        viewer.reset()
+        viewer.drawAll()
+        viewer.registerReplayCallback()
+        viewer.registerKeyCallback()
+        viewer.run()
+
+    def record(self, path, nFrames=1000, stride=1, dtype='float32', fields=('v',), ring=False):
+        # record the following steps of the model into memory-mapped files until stopRecording
+        # input: check Recorder.__init__
+        from recorder import Recorder
+        self.stopRecording()
+        self.model.recorder = Recorder(path, nFrames, stride, dtype, fields, ring)
+        self.model.recorder.open(self.model)
+        return self.model.recorder
+
+    def stopRecording(self):
+        if self.model.recorder is not None:
+            self.model.recorder.close()
+            self.model.recorder = None
+
     def reset(self):
         self.model.reset()
         self.agent.reset()
 
+    def getConfig(self):
+        # return : a small dict describing the env, an equivalent env is built with Env.fromConfig
+        #          e.g. by the worker processes of the optimizer
+        return {
+            'modelName': self.model.modelName,
+            'agentName': self.agentName,
+            'criterionName': self.criterionName,
+            'model': self.model.getConfig(),
+            'agent': self.agent.getConfig(),
+            'criterion': self.criterion.getConfig(),
+            'profile': None if self.profiler is None else {'allocations': self.profiler.allocations}
+        }
+
+    @staticmethod
+    def fromConfig(config):
+        env = Env(config['modelName'], config['agentName'], config['criterionName'], backend=config['model']['backend'],
+                  v=config['model']['v'], e=config['model']['e'], precision=config['model']['precision'])
+        env.model.setConfig(config['model'])
+        env.agent.setConfig(config['agent'])
+        env.criterion.setConfig(config['criterion'])
+        if config.get('profile') is not None:
+            from profiler import Profiler
+            env.setProfiler(Profiler(**config['profile']))
+        env.reset()
+        return env
+
+    def vector(self, nEnvs, nWorkers=0, nSubsteps=1):
+        # return : a vector env stepping nEnvs copies of this env, see vectorEnv
+        # input: nWorkers: number of worker processes, 0: the copies run in process in one BatchedModel,
+        #                  None: the number of cpus
+        #        nSubsteps: number of steps of the model per step of the vector env
+        from vectorEnv import BatchedVectorEnv, SubprocessVectorEnv
+        if nWorkers == 0:
+            return BatchedVectorEnv(self, nEnvs, nSubsteps)
+        return SubprocessVectorEnv(self, nEnvs, nWorkers, nSubsteps)
+
+    def setProfiler(self, profiler=None):
+        # time the steps of the env, the agent and the phases of the model, see Model.setProfiler
+        # the reports of the rollouts are collected in the stats of the criterion, and merged over the workers of
+        # the optimizer at each generation
+        # input: profiler: a profiler.Profiler, None: stop profiling
+        if self.profiler is not None:
+            self.profiler.detach()
+        self.profiler = profiler
+        self.model.setProfiler(profiler)
+        if profiler is not None:
+            profiler.attach(self, ['step', 'getAction'], 'env.')
+            profiler.attach(self.agent, ['nextAction', 'nextActions'], 'agent.')
+        return profiler
+
+    def getState(self):
+        # return : the state of the model and the agent, a rollout can be forked from it with setState
+        return {'model': self.model.getState(), 'agent': self.agent.getState()}
+
+    def setState(self, state):
+        self.model.setState(state['model'])
+        self.agent.setState(state['agent'])
+
     def close(self):
         del self.model
@@ -0,0 +1,82 @@
+import multiprocessing
+import numpy as np
+from criterion import mergeStats
+
+# state of a worker process, set up once by initWorker
+worker = {}
+
+
+def initWorker(config, genes, fits, nGenes):
+    # build the env of the worker from the config of the env in the main process
+    from env import Env     # imported here, env imports the optimizer which imports this module
+    worker['env'] = Env.fromConfig(config)
+    worker['genes'] = np.frombuffer(genes).reshape(-1, nGenes)
+    worker['fits'] = np.frombuffer(fits)
+
+
+def evaluateRange(iRange):
+    # evaluate the genes [start, stop) in the shared buffer and write their fitnesses back
+    # return : the stats of the rollouts
+    start, stop = iRange
+    criterion = worker['env'].criterion
+    for i in range(start, stop):
+        worker['fits'][i] = criterion(worker['genes'][i])
+    return criterion.popStats()
+
+
+class Evaluator(object):
+    # persistent pool of worker processes evaluating the criterion of an env
+    # each worker builds its own env once from Env.getConfig(), the genes and the fitnesses are exchanged
+    # through shared memory, so only the index ranges of the chunks are sent to the workers
+
+    def __init__(self, env, nWorkers=None, nMax=1, chunkSize=None):
+        # input: env: the env whose criterion is evaluated
+        #        nWorkers: number of worker processes, the number of cpus by default
+        #        nMax: max number of genes evaluated at once, the buffers grow when exceeded
+        #        chunkSize: number of genes per task, if None, the genes are split evenly among the workers
+        self.config = env.getConfig()
+        self.nGenes = env.model.actionSpace.shape[0]
+        self.nWorkers = multiprocessing.cpu_count() if nWorkers is None else nWorkers
+        self.chunkSize = chunkSize
+
+        self.nMax = None
+        self.genes = None       # shared [nMax x nGenes]
+        self.fits = None        # shared [nMax]
+        self.pool = None
+        self.stats = None       # stats of the rollouts of the last call, merged over the workers
+        self.open(nMax)
+
+    def open(self, nMax):
+        self.nMax = nMax
+        genes = multiprocessing.RawArray('d', nMax * self.nGenes)
+        fits = multiprocessing.RawArray('d', nMax)
+        self.genes = np.frombuffer(genes).reshape(nMax, self.nGenes)
+        self.fits = np.frombuffer(fits)
+        self.pool = multiprocessing.Pool(self.nWorkers, initializer=initWorker,
+                                         initargs=(self.config, genes, fits, self.nGenes))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __call__(self, pop):
+        # input: pop: [n x nGenes] genes in float
+        # return : fitnesses [n]
+        n = len(pop)
+        if n > self.nMax:
+            self.close()
+            self.open(n)
+
+        self.genes[:n] = pop
+        chunkSize = self.chunkSize or int(np.ceil(n / self.nWorkers))
+        iRanges = [(i, min(i + chunkSize, n)) for i in range(0, n, chunkSize)]
+        self.stats = mergeStats(self.pool.map(evaluateRange, iRanges, chunksize=1))
+        return np.copy(self.fits[:n])
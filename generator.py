@@ -0,0 +1,105 @@
+import os
+import json
+import numpy as np
+rootPath = os.path.split(os.path.realpath(__file__))[0]
+
+# procedural truss models, built with numpy on the vertex grid without loops over the cells
+# every function returns v [nv x 3] positions and e [ne x 2] vertex indices, deterministic for the same parameters
+# the models load with Model(name, v=v, e=e) or Env(name, ..., v=v, e=e), or are saved under data/model with save
+
+# offsets of the edges from the vertex [i, j, k] of the grid, per bracing
+axes = [(1, 0, 0), (0, 1, 0), (0, 0, 1)]
+diagonals = [(1, 1, 0), (1, 0, 1), (0, 1, 1)]                 # one diagonal per face, like the models in data/model
+diagonalsCrossed = [(1, -1, 0), (1, 0, -1), (0, 1, -1)]       # the other diagonal of the faces
+bracings = {
+    'none': axes,
+    'face': axes + diagonals,
+    'faceCross': axes + diagonals + diagonalsCrossed,
+    'tetrahedral': axes + diagonals + [(1, 1, 1)],       # each cube is split in tetrahedra by one body diagonal
+}
+
+
+def grid(nx, ny, nz, spacing=1.0):
+    # return : v [(nx + 1) * (ny + 1) * (nz + 1) x 3] positions of the vertices of the grid, in [i, j, k] order
+    ijk = np.stack(np.meshgrid(np.arange(nx + 1), np.arange(ny + 1), np.arange(nz + 1), indexing='ij'), -1)
+    return ijk.reshape(-1, 3) * float(spacing)
+
+
+def gridEdges(shape, offsets):
+    # input: shape: (nx + 1, ny + 1, nz + 1) number of vertices along each axis
+    #        offsets: list of (di, dj, dk), the edges link [i, j, k] to [i + di, j + dj, k + dk]
+    # return : e [ne x 2], grouped by offset
+    index = np.arange(np.prod(shape)).reshape(shape)
+    es = []
+    for offset in offsets:
+        slices0 = tuple(slice(max(-d, 0), n - max(d, 0)) for d, n in zip(offset, shape))
+        slices1 = tuple(slice(max(d, 0), n - max(-d, 0)) for d, n in zip(offset, shape))
+        es.append(np.stack([index[slices0].reshape(-1), index[slices1].reshape(-1)], 1))
+    return np.concatenate(es)
+
+
+def lattice(nx, ny, nz, bracing='face', spacing=1.0):
+    # an nx x ny x nz block of cubic cells
+    # input: bracing: label of the edges of the cells, check bracings
+    #        spacing: edge length of the cells
+    assert(bracing in bracings)
+    v = grid(nx, ny, nz, spacing)
+    e = gridEdges((nx + 1, ny + 1, nz + 1), bracings[bracing])
+    return v, e
+
+
+def column(n, bracing='face', spacing=1.0):
+    # a 1 x 1 x n column standing on the ground, like data/model/column.json for n = 8
+    return lattice(1, 1, n, bracing, spacing)
+
+
+def sheet(nx, ny, bracing='face', spacing=1.0):
+    # an nx x ny x 1 sheet lying on the ground, like data/model/8x8x1.json for nx = ny = 8
+    return lattice(nx, ny, 1, bracing, spacing)
+
+
+def shell(nx, ny, nz, bracing='face', spacing=1.0):
+    # the surface of an nx x ny x nz block, the inner vertices and the edges not lying on a face of the block
+    # are removed
+    assert(bracing in bracings)
+    shape = np.array([nx + 1, ny + 1, nz + 1])
+    v = grid(nx, ny, nz, 1)
+    e = gridEdges(tuple(shape), bracings[bracing])
+
+    onSide = (v == 0) | (v == shape - 1)                    # [nv x 3] on the side of the block along each axis
+    counts = [np.prod(shape - np.abs(offset)) for offset in bracings[bracing]]
+    offsets = np.repeat(np.array(bracings[bracing]), counts, 0)    # [ne x 3] offset of each edge
+    inPlane = offsets == 0                                  # [ne x 3] the edge lies in a plane normal to the axis
+    keep = np.any(inPlane & onSide[e[:, 0]] & onSide[e[:, 1]], 1)
+    e = e[keep]
+
+    used = np.zeros(len(v), dtype=bool)
+    used[e.reshape(-1)] = True
+    iNew = np.cumsum(used) - 1                              # new index of the kept vertices
+    return v[used] * float(spacing), iNew[e]
+
+
+generators = {
+    'lattice': lattice,
+    'column': column,
+    'sheet': sheet,
+    'shell': shell,
+}
+
+
+def generate(kind, **params):
+    # return : v, e of the model built by generators[kind] with params
+    return generators[kind](**params)
+
+
+def save(name, v, e, binary=False):
+    # write the model to data/model/<name>.json, loaded by Model(name)
+    # input: binary: if True, write the binary format instead, faster to load for large models, see model.saveBinary
+    if binary:
+        from model import saveBinary
+        saveBinary(name, v, e)
+        return os.path.join(rootPath, 'data/model/', name + '.model.json')
+    path = os.path.join(rootPath, 'data/model/', name + '.json')
+    with open(path, 'w') as f:
+        json.dump({'v': np.asarray(v, dtype=np.float64).tolist(), 'e': np.asarray(e).tolist()}, f)
+    return path
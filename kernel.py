@@ -0,0 +1,362 @@
+import copy
+import numpy as np
+try:
+    import numba   # optional, required by KernelNumba only
+except ImportError:
+    numba = None
+try:
+    import scipy.sparse
+    import scipy.sparse.linalg  # optional, required by KernelImplicit only
+except ImportError:
+    scipy = None
+
+
+class Kernel(object):
+    # superclass of the stepping kernels, which advance the state of a Model by a number of steps
+
+    def __init__(self, model=None):
+        self.model = model
+        self.shape = None       # (v.shape, e.shape) the buffers are allocated for
+        self.e = None           # the edge array the buffers are allocated for
+
+    def bind(self, model):
+        # return : a copy of the kernel with the same settings, stepping another model
+        kernel = copy.copy(self)
+        kernel.model = model
+        kernel.shape = None
+        return kernel
+
+    def step(self, nSteps=1):
+        raise NotImplementedError('Please implement step function.')
+
+
+class KernelNumpy(Kernel):
+    # the reference kernel, runs the computations of Model phase by phase
+
+    def step(self, nSteps=1):
+        m = self.model
+        for i in range(nSteps):
+            m.computeGeometry()
+            m.computeF()
+            m.computeVel()
+            m.computePos()
+
+
+class KernelInPlace(Kernel):
+    # the stepping kernel that allocates its working buffers once per model and updates them in place
+    # it performs the same floating point operations in the same order as Model.step, so the results are equal
+    # the buffers follow the shape of the model, so it also steps a BatchedModel
+
+    def allocate(self):
+        m = self.model
+        self.shape = (m.v.shape, m.e.shape)
+        self.e = m.e
+        self.e0 = np.ascontiguousarray(m.e[:, 0], dtype=np.intp)
+        self.e1 = np.ascontiguousarray(m.e[:, 1], dtype=np.intp)
+
+        ne = m.e.shape[0]
+        shapeV = m.v.shape                          # [nv x 3]
+        shapeE = m.v.shape[:-2] + (ne, 3)           # [ne x 3]
+        shapeL = m.v.shape[:-2] + (ne, 1)           # [ne x 1]
+        dtype = m.v.dtype                           # float32 models get float32 buffers
+
+        # gathered end positions and velocities, shared by the length and the force computation
+        self.v0 = np.empty(shapeE, dtype)
+        self.v1 = np.empty(shapeE, dtype)
+        self.vel0 = np.empty(shapeE, dtype)
+        self.vel1 = np.empty(shapeE, dtype)
+        self.displacement = np.empty(shapeE, dtype)     # v1 - v0
+        self.dispUnit = np.empty(shapeE, dtype)         # displacement / l ** 2, used for the damping of FEdge
+        self.dispUnitS = np.empty(shapeE, dtype)        # displacement / l, used for the scatter
+        self.tmpE = np.empty(shapeE, dtype)
+        self.FsEdge = np.empty(shapeE, dtype)
+        self.FEnds = np.empty(m.v.shape[:-2] + (2 * ne, 3), dtype)
+
+        self.lSquared = np.empty(shapeL, dtype)
+        self.l = np.empty(shapeL, dtype)
+        self.l0 = np.empty(shapeL, dtype)
+        self.FEdge = np.empty(shapeL, dtype)
+        self.Fk = np.empty(shapeL, dtype)
+        self.mVel0 = np.empty(shapeL, dtype)
+        self.mVel1 = np.empty(shapeL, dtype)
+        self.tmpL = np.empty(shapeL, dtype)
+
+        self.Fg = np.empty(3, dtype)
+        self.F = np.empty(shapeV, dtype)
+        self.tmpV = np.empty(shapeV, dtype)
+        self.maskContact = np.empty(shapeV[:-1], dtype=bool)
+        self.mask = np.empty(shapeV[:-1], dtype=bool)
+
+    def step(self, nSteps=1):
+        m = self.model
+        if self.shape != (m.v.shape, m.e.shape) or self.e is not m.e:
+            self.allocate()
+
+        ne = self.e0.shape[0]
+        v0, v1, vel0, vel1 = self.v0, self.v1, self.vel0, self.vel1
+        d, u, uS, tmpE = self.displacement, self.dispUnit, self.dispUnitS, self.tmpE
+        l, l0, lSquared, FEdge, Fk, tmpL = self.l, self.l0, self.lSquared, self.FEdge, self.Fk, self.tmpL
+        F, tmpV, maskContact, mask = self.F, self.tmpV, self.maskContact, self.mask
+
+        np.multiply(m.gUnit, m.g, out=self.Fg)
+
+        # the shrinkage and the pressure are constant during a call, the target lengths are computed once
+        np.multiply(m.s, m.pressure, out=l0)
+        np.subtract(1, l0, out=l0)
+        np.multiply(m.lInit, l0, out=l0)
+
+        Fs = m.Fs
+        for i in range(nSteps):
+            v, vel = m.v, m.vel
+
+            # geometry
+            np.take(v, self.e0, -2, out=v0)
+            np.take(v, self.e1, -2, out=v1)
+            np.subtract(v1, v0, out=d)
+            np.square(d, out=tmpE)
+            np.sum(tmpE, -1, out=lSquared[..., 0])
+            np.sqrt(lSquared, out=l)
+
+            np.less_equal(v[..., 2], 0, out=maskContact)
+
+            # edge force
+            np.subtract(l, l0, out=Fk)
+            np.multiply(m.kEd, Fk, out=Fk)
+
+            np.divide(d, lSquared, out=u)
+            np.take(vel, self.e0, -2, out=vel0)
+            np.take(vel, self.e1, -2, out=vel1)
+            np.multiply(vel0, u, out=tmpE)
+            np.sum(tmpE, -1, out=self.mVel0[..., 0])
+            np.multiply(vel1, u, out=tmpE)
+            np.sum(tmpE, -1, out=self.mVel1[..., 0])
+            np.subtract(self.mVel1, self.mVel0, out=tmpL)
+            np.power(tmpL, 3, out=tmpL)
+            np.multiply(m.dampingSpring, tmpL, out=tmpL)
+            np.add(Fk, tmpL, out=FEdge)
+
+            # scatter to vertices
+            np.divide(d, l, out=uS)
+            np.multiply(FEdge, uS, out=self.FsEdge)
+            np.subtract(vel1, vel0, out=tmpE)
+            np.multiply(tmpE, uS, out=tmpE)
+            np.multiply(tmpE, m.dampingSpring, out=tmpE)
+            np.add(self.FsEdge, tmpE, out=self.FEnds[..., :ne, :])
+            np.subtract(tmpE, self.FsEdge, out=self.FEnds[..., ne:, :])
+            Fs = np.bincount(m.iScatter, weights=self.FEnds.reshape(-1), minlength=v.size).reshape(v.shape)
+            Fs = Fs.astype(v.dtype, copy=False)     # bincount sums in float64
+            np.add(Fs, self.Fg, out=F)
+
+            # velocity
+            np.divide(F, m.m, out=tmpV)
+            np.multiply(tmpV, m.h, out=tmpV)
+            np.add(vel, tmpV, out=vel)
+            np.multiply(vel, 1 - m.damping, out=vel)
+
+            if m.ground == 2:
+                np.less(vel[..., 0], 0, out=mask)
+                np.logical_and(mask, maskContact, out=mask)
+                np.copyto(vel[..., 0], 0, where=mask)
+            elif m.ground == 1:
+                np.copyto(vel[..., 0], 0, where=maskContact)
+                np.copyto(vel[..., 1], 0, where=maskContact)
+
+            np.less(v[..., 2], 0, out=mask)
+            np.logical_and(maskContact, mask, out=mask)
+            np.copyto(v[..., 2], 0, where=mask)
+
+            # position
+            np.multiply(m.h, vel, out=tmpV)
+            np.add(v, tmpV, out=v)
+            np.multiply(m.h ** 2, F, out=tmpV)
+            np.divide(tmpV, 2, out=tmpV)
+            np.add(v, tmpV, out=v)
+
+        m.l, m.l0, m.maskContact, m.FEdge, m.Fs, m.Fg, m.F = l, l0, maskContact, FEdge, Fs, self.Fg, F
+
+
+def stepFused(v, vel, e, s, lInit, pressure, nSteps, h, m, kEd, dampingSpring, damping, Fg, ground,
+              l, l0, FEdge, Fs, F, maskContact):
+    # nSteps of Model.step on a single model in one loop nest, compiled by numba if it is installed
+    # input: v, vel: [nv x 3], updated in place
+    #        e: [ne x 2] int64, s, lInit: [ne]
+    #        l, l0, FEdge: [ne], Fs, F: [nv x 3], maskContact: [nv] output buffers
+    nv = v.shape[0]
+    ne = e.shape[0]
+    for j in range(ne):
+        l0[j] = lInit[j] * (1 - s[j] * pressure)     # constant during a call
+
+    for it in range(nSteps):
+        for i in range(nv):
+            maskContact[i] = v[i, 2] <= 0
+            for k in range(3):
+                Fs[i, k] = 0.0
+
+        for j in range(ne):
+            a = e[j, 0]
+            b = e[j, 1]
+            dx = v[b, 0] - v[a, 0]
+            dy = v[b, 1] - v[a, 1]
+            dz = v[b, 2] - v[a, 2]
+            lSquared = dx * dx + dy * dy + dz * dz
+            l[j] = np.sqrt(lSquared)
+
+            mVel0 = (vel[a, 0] * dx + vel[a, 1] * dy + vel[a, 2] * dz) / lSquared
+            mVel1 = (vel[b, 0] * dx + vel[b, 1] * dy + vel[b, 2] * dz) / lSquared
+            dVel = mVel1 - mVel0
+            FEdge[j] = kEd * (l[j] - l0[j]) + dampingSpring * dVel ** 3
+
+            for k, d in enumerate((dx, dy, dz)):
+                u = d / l[j]
+                fs = FEdge[j] * u
+                fd = (vel[b, k] - vel[a, k]) * u * dampingSpring
+                Fs[a, k] += fs + fd
+                Fs[b, k] += fd - fs
+
+        for i in range(nv):
+            for k in range(3):
+                F[i, k] = Fs[i, k] + Fg[k]
+                vel[i, k] = (vel[i, k] + F[i, k] / m * h) * (1 - damping)
+            if maskContact[i]:
+                if ground == 2 and vel[i, 0] < 0:
+                    vel[i, 0] = 0.0
+                elif ground == 1:
+                    vel[i, 0] = 0.0
+                    vel[i, 1] = 0.0
+                if v[i, 2] < 0:
+                    v[i, 2] = 0.0
+            for k in range(3):
+                v[i, k] = v[i, k] + h * vel[i, k] + h * h * F[i, k] / 2
+
+
+if numba is not None:
+    stepFused = numba.njit(cache=True)(stepFused)
+
+
+class KernelNumba(Kernel):
+    # the kernel that runs all the nSteps in one compiled call of stepFused, without returning to python
+    # the forces of the edges are summed in a different order, so it equals Model.step up to round-off
+    available = numba is not None
+
+    def allocate(self):
+        m = self.model
+        self.shape = (m.v.shape, m.e.shape)
+        self.e = m.e
+        self.eFused = np.ascontiguousarray(m.e, dtype=np.int64)
+
+        shapeL = m.v.shape[:-2] + (m.e.shape[0], 1)
+        dtype = m.v.dtype
+        self.l = np.empty(shapeL, dtype)
+        self.l0 = np.empty(shapeL, dtype)
+        self.FEdge = np.empty(shapeL, dtype)
+        self.Fs = np.empty(m.v.shape, dtype)
+        self.F = np.empty(m.v.shape, dtype)
+        self.maskContact = np.empty(m.v.shape[:-1], dtype=bool)
+
+    def step(self, nSteps=1):
+        m = self.model
+        if self.shape != (m.v.shape, m.e.shape) or self.e is not m.e:
+            self.allocate()
+
+        nv, ne = m.v.shape[-2], m.e.shape[0]
+        m.v = np.ascontiguousarray(m.v)
+        m.vel = np.ascontiguousarray(m.vel)
+        Fg = np.asarray(m.gUnit * m.g, dtype=m.v.dtype)
+        real = m.v.dtype.type   # the scalars have the dtype of the model, so that float32 is not computed in float64
+
+        # copies of a BatchedModel are stepped one after the other
+        v, vel = m.v.reshape(-1, nv, 3), m.vel.reshape(-1, nv, 3)
+        s = np.broadcast_to(m.s.reshape(-1, ne), (v.shape[0], ne))
+        lInit = np.broadcast_to(m.lInit.reshape(-1, ne), (v.shape[0], ne))
+        l, l0, FEdge = self.l.reshape(-1, ne), self.l0.reshape(-1, ne), self.FEdge.reshape(-1, ne)
+        Fs, F, maskContact = self.Fs.reshape(-1, nv, 3), self.F.reshape(-1, nv, 3), self.maskContact.reshape(-1, nv)
+        for b in range(v.shape[0]):
+            stepFused(v[b], vel[b], self.eFused, np.ascontiguousarray(s[b]), np.ascontiguousarray(lInit[b]),
+                      real(m.pressure), nSteps, real(m.h), real(m.m), real(m.kEd), real(m.dampingSpring),
+                      real(m.damping), Fg, int(m.ground), l[b], l0[b], FEdge[b], Fs[b], F[b], maskContact[b])
+
+        m.l, m.l0, m.maskContact, m.FEdge, m.Fs, m.Fg, m.F = self.l, self.l0, self.maskContact, self.FEdge, \
+            self.Fs, Fg, self.F
+
+
+class KernelImplicit(Kernel):
+    # linearized backward Euler, stable with much larger step sizes than the explicit kernels
+    # the final shapes stay within 5% of the size of the model of those of the explicit kernels at hDamping up to
+    # h = 20 hDamping, see utils/compareIntegrators.py; larger steps are stable but the shapes lag behind
+    # (m I - h^2 K) dVel = h (F + h K vel), vel += dVel, v += h vel + h^2 F' / 2, F' = m dVel / h
+    # K = dF / dv is the sparse stiffness of the edge springs (kEd), F' the force of the step with the springs
+    # linearized at its end, it replaces F in the velocity and position updates of Model.step, so that the steps
+    # equal those of the explicit kernels up to O(h^2) per step
+    # the damping of the springs, the friction and the contact with the ground stay explicit, as in Model.step
+    # the velocity discount of Model.damping is applied per step, it is rescaled from hDamping to h so that a
+    # constant force moves the vertices at the same speed, the drift of the strongly damped truss
+    available = scipy is not None
+
+    def __init__(self, model=None, hDamping=None):
+        # input: hDamping: the step size Model.damping was tuned for, the current step size by default
+        super().__init__(model)
+        if not self.available:
+            raise ImportError('The implicit integrator requires scipy.')
+        self.hDamping = model.h if hDamping is None else hDamping
+
+    def allocate(self):
+        # index of the 3x3 blocks of the stiffness matrix of every edge, over the stacked copies of a BatchedModel
+        m = self.model
+        self.shape = (m.v.shape, m.e.shape)
+        self.e = m.e
+
+        nv = m.v.shape[-2]
+        self.nDofs = m.v.size
+        nBatch = self.nDofs // (nv * 3)
+        e = (m.e.astype(np.intp) + (np.arange(nBatch) * nv)[:, np.newaxis, np.newaxis]).reshape(-1, 2)
+        dofs0 = e[:, 0:1] * 3 + np.arange(3)    # [ne x 3]
+        dofs1 = e[:, 1:2] * 3 + np.arange(3)
+
+        rows, cols = [], []
+        for p, q in [(dofs0, dofs0), (dofs1, dofs1), (dofs0, dofs1), (dofs1, dofs0)]:
+            rows.append(np.broadcast_to(p[:, :, np.newaxis], p.shape + (3,)).reshape(-1))
+            cols.append(np.broadcast_to(q[:, np.newaxis, :], p.shape + (3,)).reshape(-1))
+        self.rows = np.concatenate(rows)
+        self.cols = np.concatenate(cols)
+
+    def computeStiffness(self):
+        # return : the stiffness matrix K [3nv x 3nv] of the springs at the current state
+        m = self.model
+        displacement = (m.v[..., m.e[:, 1], :] - m.v[..., m.e[:, 0], :]).reshape(-1, 3)
+        l = m.l.reshape(-1, 1)
+        u = displacement / l
+        ratio = np.maximum(1 - m.l0.reshape(-1, 1) / l, 0)[:, :, np.newaxis]     # clamped to keep K definite
+        uu = u[:, :, np.newaxis] * u[:, np.newaxis, :]
+        Ke = m.kEd * (uu + ratio * (np.eye(3) - uu))   # [ne x 3 x 3] dF_{v0} / dv_{v1}
+
+        data = np.concatenate([-Ke.reshape(-1), -Ke.reshape(-1), Ke.reshape(-1), Ke.reshape(-1)])
+        return scipy.sparse.csr_matrix((data, (self.rows, self.cols)), shape=(self.nDofs, self.nDofs))
+
+    def step(self, nSteps=1):
+        m = self.model
+        if self.shape != (m.v.shape, m.e.shape) or self.e is not m.e:
+            self.allocate()
+
+        # a constant force F moves the vertices by h vel + h^2 F / 2 per step, with vel = discount / (1 - discount) h F
+        # at the end, i.e. at ((1 - damping) / damping + 1 / 2) hDamping F per unit of time with the explicit kernels;
+        # beyond about 20 hDamping, the h^2 F / 2 term alone is faster and the velocity is fully discounted
+        discount = 1
+        if m.damping > 0:
+            ratio = max(((1 - m.damping) / m.damping + 0.5) * self.hDamping / m.h - 0.5, 0)
+            discount = ratio / (1 + ratio)
+        identity = scipy.sparse.identity(self.nDofs, format='csr')
+        for i in range(nSteps):
+            m.computeGeometry()
+            m.computeF()
+            K = self.computeStiffness()
+
+            vel = m.vel.reshape(-1)
+            A = identity * m.m - m.h ** 2 * K
+            b = m.h * (m.F.reshape(-1) + m.h * (K @ vel))
+            dVel = scipy.sparse.linalg.spsolve(A.tocsc(), b).reshape(m.v.shape)    # solved in float64
+            m.F = (m.m * dVel / m.h).astype(m.v.dtype, copy=False)
+
+            m.vel = ((m.vel + dVel) * discount).astype(m.v.dtype, copy=False)
+            m.computeVelGndFrc()
+            m.computeVelGndCon()
+            m.computePos()
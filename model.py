@@ -1,13 +1,98 @@
 import os
 import json
+import hashlib
 import numpy as np
 from gym import spaces
+from kernel import KernelNumpy, KernelInPlace, KernelNumba, KernelImplicit
 rootPath = os.path.split(os.path.realpath(__file__))[0]
+modelPath = os.path.join(rootPath, 'data/model/')
+
+# binary model format, next to or instead of <name>.json under data/model:
+# <name>.v.npy [nv x 3] float64 positions, <name>.e.npy [ne x 2] edges in the narrowest unsigned int type,
+# <name>.model.json header {'version', 'nv', 'ne', 'vDtype', 'eDtype', 'hash'}, hash is the one of Model.getHash
+# the arrays are memory-mapped read-only, so the worker processes loading the same model share the pages of the edges
+binaryVersion = 1
+
+
+def getModelNames():
+    # return : sorted names of the models under data/model, in either format
+    names = set()
+    for fileName in os.listdir(modelPath):
+        if fileName.endswith('.model.json'):
+            names.add(fileName[:-len('.model.json')])
+        elif fileName.endswith('.json'):
+            names.add(fileName[:-len('.json')])
+    return sorted(names)
+
+
+def hashGeometry(v, e):
+    # return : hex digest of the positions and the edges, independent of their dtypes
+    h = hashlib.sha1(np.ascontiguousarray(v, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(e, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+def getIndexType(n):
+    # return : the narrowest unsigned int type indexing n vertices
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if n <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def saveBinary(name, v, e):
+    # write the model to data/model/<name>.v.npy, .e.npy and .model.json, loaded by Model(name)
+    # the header is replaced last, so that concurrent loads never see partial arrays
+    v = np.ascontiguousarray(v, dtype=np.float64)
+    e = np.ascontiguousarray(e, dtype=getIndexType(len(v)))
+    header = {'version': binaryVersion, 'nv': len(v), 'ne': len(e), 'vDtype': v.dtype.str, 'eDtype': e.dtype.str,
+              'hash': hashGeometry(v, e)}
+
+    path = os.path.join(modelPath, name)
+    tmp = '.{}.tmp'.format(os.getpid())
+    for suffix, x in [('.v.npy', v), ('.e.npy', e)]:
+        with open(path + suffix + tmp, 'wb') as f:
+            np.save(f, x, allow_pickle=False)
+    with open(path + '.model.json' + tmp, 'w') as f:
+        json.dump(header, f)
+    os.replace(path + '.v.npy' + tmp, path + '.v.npy')
+    os.replace(path + '.e.npy' + tmp, path + '.e.npy')
+    os.replace(path + '.model.json' + tmp, path + '.model.json')
+    return header
+
+
+def loadBinary(name):
+    # return : v [nv x 3], e [ne x 2] read-only memory maps, the header
+    path = os.path.join(modelPath, name)
+    with open(path + '.model.json') as f:
+        header = json.load(f)
+    if header['version'] != binaryVersion:
+        raise ValueError('Unsupported version {} of the binary model {}'.format(header['version'], name))
+    v = np.load(path + '.v.npy', mmap_mode='r')
+    e = np.load(path + '.e.npy', mmap_mode='r')
+    if v.shape != (header['nv'], 3) or e.shape != (header['ne'], 2) or \
+            v.dtype.str != header['vDtype'] or e.dtype.str != header['eDtype']:
+        raise ValueError('The arrays of the binary model {} do not match its header'.format(name))
+    return v, e, header
+
+
+def hasBinary(name):
+    # return : whether the binary model exists and is not older than the json model of the same name
+    path = os.path.join(modelPath, name)
+    if not os.path.exists(path + '.model.json'):
+        return False
+    if not os.path.exists(path + '.json'):
+        return True
+    return os.path.getmtime(path + '.json') <= os.path.getmtime(path + '.model.json')
 
 
 class Model(object):
-    def __init__(self, modelName='tet'):
+    def __init__(self, modelName='tet', backend=None, v=None, e=None, precision='float64'):
         # input: modelName: the file name of the geometry model, under ./data/model
+        #        backend: label of the stepping kernel, check the dict in Model.setBackend()
+        #        v, e: if set, the geometry [nv x 3], [ne x 2] used instead of the file, e.g. built by generator.py,
+        #              modelName then only labels the model
+        #        precision: 'float64' or 'float32', the dtype of the state, the forces, the spaces and the actions
 
         # ======= variable =======
         self.v = None       # vertices locations    [nv x 3]
@@ -20,6 +105,7 @@ class Model(object):
         self.l = None       # current lengths       [ne x 1]
         self.lInit = None   # initial lengths       [ne x 1]
         self.l0 = None      # original length after shrinking: target length [ne x 1]
+        self.iScatter = None    # flat index of (vertex, axis) for each edge end, [2ne*3] int
 
         self.Fs = None          # F_{spring} [nv x 3]
         self.Fg = None          # F_{gravity}   [nv x 3]  always downwards
@@ -30,6 +116,10 @@ class Model(object):
         self.nSteps = 0
         self.time = 0
 
+        self.backend = None     # label of the stepping kernel
+        self.integrator = 'explicit'    # 'explicit': the kernel of the backend, 'implicit': KernelImplicit
+        self.kernel = None      # stepping kernel that advances the simulation
+
         # ======= constant =======
         self.m = 1
         self.mu = 1.0           # friction coefficient
@@ -43,35 +133,141 @@ class Model(object):
         self.sMax = 0.3         # max shrinkage ratio
         self.h = 0.004          # step size
 
+        # ======= adaptive stepping, see setAdaptive =======
+        self.adaptive = False   # if True, each step takes the largest step size keeping the error under tolerance
+        self.hRef = None        # step size the constants were tuned for, the velocity damping is rescaled from it
+        self.hMin = None        # min step size
+        self.hMax = None        # max step size
+        self.tolerance = None   # max position error of a step, relative to the shortest edge
+        self.stateAdaptive = None   # state at the start of the adaptive step, the buffers are reused
+        self.vFull = None           # positions after the full step of the error estimate
+
         self.ground = 0  # 0: smooth, 1: all friction, 2: directional friction
         self.modelName = modelName
+        assert(precision in ['float64', 'float32'])
+        self.dtype = np.dtype(precision)    # the constants stay python floats, so they do not upcast float32 arrays
+        self.vSource = None if v is None else np.asarray(v, dtype=np.float64)    # geometry not read from a file
+        self.eSource = None if e is None else np.asarray(e)
 
         # ======= spaces =======
         self.actionSpace = None
         self.observationSpace = None
 
+        # ======= recording =======
+        self.recorder = None        # if set, a Recorder writing the trajectory, see Env.record
+        self.profiler = None        # if set, a Profiler timing the phases of the steps, see setProfiler
+
+        # ======= snapshot =======
+        self.geometryHash = None    # hash of the geometry as loaded, see getHash
+        self.snapshot = None        # pristine state right after loading the model, restored by reset
+        self.definition = None      # the model definition the snapshot was taken for
+        self.modelTime = None       # modification time of the model file as read, None if given v and e
+
         # ======= init =======
+        self.setBackend(backend)
         self.reset()
 
     def reset(self):
-        # reset
+        # reset, restore the pristine snapshot unless the model definition has changed
+        if self.adaptive:
+            self.h = self.hRef
+        if self.snapshot is not None and self.definition == self.getDefinition():
+            self.setState(self.snapshot)
+            return
+
         self.read(self.modelName)
+        self.computeIncidence()
         self.nSteps = 0
         self.time = 0
 
         #  initialize parameters
-        self.s = np.zeros([self.e.shape[0], 1])  # shrinkage
+        self.s = np.zeros([self.e.shape[0], 1], dtype=self.dtype)  # shrinkage
         self.pressure = 1
         self.vel = np.zeros_like(self.v)
 
         self.computeLength()
-        self.lInit = self.l
+        self.lInit = np.copy(self.l)
         self.computeGeometry()
         self.computeF()
 
         self.getObservation()
         self.getSpaces()
 
+        self.snapshot = self.getState()
+        self.definition = self.getDefinition()
+
+    # =============== config ===============
+    configKeys = ['m', 'mu', 'kGd', 'kEd', 'damping', 'dampingSpring', 'dampingGround', 'g', 'gUnit', 'sMax', 'h',
+                  'ground', 'adaptive', 'hRef', 'hMin', 'hMax', 'tolerance']
+
+    def getConfig(self):
+        # return : a small dict of the settings of the model, another model is set up the same way by setConfig
+        config = {k: getattr(self, k) for k in self.configKeys}
+        config['modelName'] = self.modelName
+        config['precision'] = self.dtype.name
+        config['v'] = self.vSource
+        config['e'] = self.eSource
+        config['backend'] = self.backend
+        config['integrator'] = self.integrator
+        config['hDamping'] = getattr(self.kernel, 'hDamping', None)
+        return config
+
+    def setConfig(self, config):
+        # input: config: dict returned by getConfig, the model is reset
+        for k in self.configKeys:
+            setattr(self, k, config[k])
+        self.modelName = config['modelName']
+        self.dtype = np.dtype(config['precision'])
+        if config['v'] is not self.vSource or config['e'] is not self.eSource:
+            self.vSource = None if config['v'] is None else np.asarray(config['v'], dtype=np.float64)
+            self.eSource = None if config['e'] is None else np.asarray(config['e'])
+            self.snapshot = None    # reload the geometry
+        self.setBackend(config['backend'])
+        if config['integrator'] == 'implicit':
+            self.kernel = KernelImplicit(self, hDamping=config['hDamping'])
+            self.integrator = 'implicit'
+            self.attachProfiler()
+        self.reset()
+
+    # =============== state ===============
+    stateArrays = ['v', 'vel', 's', 'l', 'lInit', 'l0', 'maskContact', 'FEdge', 'Fs', 'Fg', 'F']
+    stateScalars = ['pressure', 'nSteps', 'time']
+
+    def getDefinition(self):
+        # return : the settings the snapshot depends on, reset reloads the model when they change
+        return (self.modelName, self.modelTime, self.sMax, self.kEd, self.dampingSpring, self.g,
+                tuple(float(x) for x in self.gUnit), self.dtype)
+
+    def getState(self, out=None):
+        # input: out: a state returned by getState, its arrays are overwritten in place if they fit
+        # return : a copy of the simulation state, the model can be restored to it with setState
+        state = {}
+        for k in self.stateArrays:
+            x = getattr(self, k)
+            if out is not None and out[k].shape == x.shape and out[k].dtype == x.dtype:
+                state[k] = out[k]
+                np.copyto(state[k], x)
+            else:
+                state[k] = np.copy(x)
+        state.update({k: getattr(self, k) for k in self.stateScalars})
+        state['definition'] = self.getDefinition()      # checked by setState
+        return state
+
+    def setState(self, state):
+        # restore the simulation state saved by getState
+        # input: state: dict returned by getState, arrays are copied into the current buffers in place
+        if state.get('definition') is not None and state['definition'] != self.getDefinition():
+            raise ValueError('The state was saved for another definition of the model {}: {} instead of {}'.format(
+                self.modelName, state['definition'], self.getDefinition()))
+        for k in self.stateArrays:
+            x = getattr(self, k)
+            if isinstance(x, np.ndarray) and x.shape == state[k].shape and x.dtype == state[k].dtype:
+                np.copyto(x, state[k])
+            else:
+                setattr(self, k, np.copy(state[k]))
+        for k in self.stateScalars:
+            setattr(self, k, state[k])
+
     # =============== info ===============
     def json(self):
         # return : a json string including v and e information, mainly for web interface
@@ -81,45 +277,79 @@ class Model(object):
         js = json.dumps(data)
         return js
 
-    def getObservation(self):
-        # return : the observation of the environment, not used yet.
-        v0 = self.v[0]                        # position of v0
-        v = (self.v - self.v[0])              # relative positions of vs to v0
-        vel = self.vel
-        observation = np.vstack([v0, v, vel]).reshape(-1)
-        return observation
+    def getObservation(self, out=None):
+        # return : the observation of the environment, the position of v0, the positions of the vertices relative
+        #          to v0 and the velocities [(2nv + 1) * 3], [... x (2nv + 1) * 3] for a BatchedModel
+        # input: out: if set, the contiguous buffer the observation is written into, e.g. shared with a vector env
+        nv = self.v.shape[-2]
+        if out is None:
+            out = np.empty(self.v.shape[:-2] + ((2 * nv + 1) * 3,), dtype=self.v.dtype)
+        observation = out.reshape(self.v.shape[:-2] + (2 * nv + 1, 3))   # a view of out
+        v0 = self.v[..., :1, :]                 # position of v0
+        observation[..., :1, :] = v0
+        np.subtract(self.v, v0, out=observation[..., 1:nv + 1, :])     # relative positions of vs to v0
+        observation[..., nv + 1:, :] = self.vel
+        return out
+
+    def getHash(self):
+        # return : hex digest of the geometry of the model as loaded, identifies the model definition
+        #          computed once per load, or read from the header of a binary model
+        if self.geometryHash is None:
+            self.geometryHash = hashGeometry(self.snapshot['v'], self.e)
+        return self.geometryHash
 
     def getCentroid(self):
-        return np.sum(self.v, 0) / self.v.shape[0]
+        return np.sum(self.v, -2) / self.v.shape[-2]
 
     def getSpaces(self):
         self.actionSpace = spaces.Box(
-            low=np.zeros(self.s.shape[0]),
-            high=np.full(self.s.shape[0], self.sMax),
-            dtype=np.float64
+            low=np.zeros(self.s.shape[0], dtype=self.dtype),
+            high=np.full(self.s.shape[0], self.sMax, dtype=self.dtype),
+            dtype=self.dtype
         )
         observation = self.getObservation()
         self.observationSpace = spaces.Box(
-            low=np.full(observation.shape[0], -np.Inf),
-            high=np.full(observation.shape[0], np.Inf),
-            dtype=np.float64
+            low=np.full(observation.shape[0], -np.Inf, dtype=self.dtype),
+            high=np.full(observation.shape[0], np.Inf, dtype=self.dtype),
+            dtype=self.dtype
         )
         return self.actionSpace, self.observationSpace
 
     # =============== environment setting ===============
     def read(self, name='tet'):
-        # read the geometry of the bot from a json file
-        # input: name: file name of the geometry file in json format under 'data/model/' folder
+        # read the geometry of the bot from the binary or the json files, or copy the geometry the model was given
+        # input: name: file name of the geometry under 'data/model/' folder, the binary model is read if it is
+        #              up to date, see saveBinary
 
         self.modelName = name
+        self.geometryHash = None
+        self.modelTime = None
+        if self.vSource is not None:
+            self.v = np.array(self.vSource, dtype=self.dtype)
+            self.e = np.copy(self.eSource)
+            return
+        if hasBinary(name):
+            v, self.e, header = loadBinary(name)   # the edges stay memory-mapped and shared between the processes
+            self.modelTime = os.path.getmtime(os.path.join(modelPath, name + '.model.json'))
+            self.v = np.array(v, dtype=self.dtype)
+            if self.dtype == v.dtype:
+                self.geometryHash = header['hash']
+            return
         self.v = []
         self.e = []
-        name = os.path.join(rootPath, "data/model/", name+".json")
+        name = os.path.join(modelPath, name+".json")
+        self.modelTime = os.path.getmtime(name)
         with open(name) as f:
             content = f.read()
             data = json.loads(content)
             self.e = np.array(data['e'])
-            self.v = np.array(data['v'])
+            self.v = np.array(data['v'], dtype=self.dtype)
+
+    def computeIncidence(self):
+        # build the vertex-edge incidence once per model load
+        # the forces of the edge ends [2ne x 3] are scattered to F[nv x 3] with np.bincount over iScatter
+        iEnds = np.concatenate([self.e[:, 0], self.e[:, 1]]).astype(np.intp)  # [2ne] vertex of each edge end
+        self.iScatter = (iEnds[:, np.newaxis] * 3 + np.arange(3)).reshape(-1)
 
     def smooth(self):
         self.ground = 0
@@ -131,14 +361,18 @@ class Model(object):
         self.ground = 2
 
     # =============== robot setting ===============
-    def setShrinkage(self, s=None):
+    def setShrinkage(self, s=None, check=True):
+        # input: check: if False, s is not checked against the action space, e.g. it was when the schedule of a
+        #               rollout was compiled, see Env.rollout
         if s is None:
             s = self.s * 0
         elif type(s) in [float, int]:
             s = np.ones_like(self.s) * s
         else:
-            s = np.array(s).reshape(-1, 1)
-        assert (self.actionSpace.contains(s.reshape(-1)))
+            s = np.array(s, dtype=self.dtype).reshape(-1, 1)
+        assert (not check or self.actionSpace.contains(s.reshape(-1)))
+        if self.adaptive and not np.array_equal(s, self.s):
+            self.h = max(self.h / 4, self.hMin)    # actuation switch, restart with small steps
         self.s = s
 
     def setPressure(self, pressure=1):
@@ -146,18 +380,76 @@ class Model(object):
         self.pressure = pressure
 
     # =============== numerical simulation ===============
+    def setBackend(self, backend=None):
+        # input: backend: label of the stepping kernel, if None, $TRUSSBOT_BACKEND or 'numpy'
+        #           'numpy': the computations below, phase by phase
+        #           'inPlace': the same computations on buffers allocated once, bitwise equal to 'numpy'
+        #           'numba': all the steps of a call in one compiled loop, falls back to 'inPlace' without numba
+        if backend is None:
+            backend = os.environ.get('TRUSSBOT_BACKEND', 'numpy')
+        kernelDict = {
+            'numpy': KernelNumpy,
+            'inPlace': KernelInPlace,
+            'numba': KernelNumba
+        }
+        assert(backend in kernelDict)
+        if backend == 'numba' and not KernelNumba.available:
+            print('Numba is not installed, the inPlace backend is used instead.')
+            backend = 'inPlace'
+        self.backend = backend
+        self.integrator = 'explicit'
+        self.kernel = kernelDict[backend](self)
+        self.attachProfiler()
+        return self.kernel
+
+    # profiling
+    profilePhases = ['step', 'stepAdaptive', 'setShrinkage', 'computeGeometry', 'computeFEdge', 'computeFShrinkage',
+                     'computeFg', 'computeFn', 'computeF', 'computeVelGndFrc', 'computeVelGndCon',
+                     'computeVelDamping', 'computeVel', 'computePos']
+
+    def setProfiler(self, profiler=None):
+        # time the phases of the steps, read with profiler.getReport()
+        # input: profiler: a profiler.Profiler, None: stop profiling
+        #        the phases of the numpy backend are timed one by one, the other kernels as a whole in 'kernel.step'
+        if self.profiler is not None:
+            self.profiler.detach()
+        self.profiler = profiler
+        self.attachProfiler()
+
+    def attachProfiler(self):
+        # wrap the phases of the model and of its current kernel
+        if self.profiler is not None:
+            self.profiler.attach(self, Model.profilePhases)
+            self.profiler.attach(self.kernel, ['step'], 'kernel.')
+
+    def setIntegrator(self, integrator='explicit', h=None):
+        # input: integrator: 'explicit': step with the kernel of the backend
+        #                    'implicit': step with KernelImplicit, which allows larger step sizes, requires scipy
+        #        h: the new step size, the velocity damping of 'implicit' stays tuned to the current step size,
+        #           'implicit' gives the shapes of 'explicit' at the current step size up to h = 20 times it
+        assert(integrator in ['explicit', 'implicit'])
+        if integrator == 'implicit':
+            self.kernel = KernelImplicit(self, hDamping=self.h)
+            self.attachProfiler()
+        else:
+            self.setBackend(self.backend)
+        self.integrator = integrator
+        if h is not None:
+            self.h = h
+        return self.kernel
 
     # compute geometry
+    # the computations index with ``...`` so that they also run on a batch of models, see BatchedModel
     def computeLength(self):
-        v0 = self.v[self.e[:, 0]].reshape(-1, 3)
-        v1 = self.v[self.e[:, 1]].reshape(-1, 3)
-        self.l = np.sqrt(np.sum((v0 - v1) ** 2, 1)).reshape(-1, 1)
+        v0 = self.v[..., self.e[:, 0], :]
+        v1 = self.v[..., self.e[:, 1], :]
+        self.l = np.sqrt(np.sum((v0 - v1) ** 2, -1))[..., np.newaxis]
 
     def computeLength0(self):
         self.l0 = self.lInit * (1 - self.s * self.pressure)
 
     def computeContact(self):
-        self.maskContact = (self.v[:, 2] <= 0)
+        self.maskContact = (self.v[..., 2] <= 0)
 
     def computeGeometry(self):
         self.computeLength()
@@ -168,42 +460,39 @@ class Model(object):
     def computeFEdge(self):
         Fk = self.kEd * (self.l - self.l0)
 
-        v0 = self.v[self.e[:, 0]]  # [ne x 3]
-        v1 = self.v[self.e[:, 1]]
+        v0 = self.v[..., self.e[:, 0], :]  # [ne x 3]
+        v1 = self.v[..., self.e[:, 1], :]
         displacement = v1 - v0
-        norm = np.sum(displacement ** 2, 1).reshape(-1, 1)
+        norm = np.sum(displacement ** 2, -1)[..., np.newaxis]
         dispUnit = displacement / norm  # [ne x 3]
 
-        vel0 = self.vel[self.e[:, 0]]  # [ne x 3]
-        vel1 = self.vel[self.e[:, 1]]
-        mVel0 = np.sum(vel0 * dispUnit, 1).reshape(-1, 1)  # [ne x 1]
-        mVel1 = np.sum(vel1 * dispUnit, 1).reshape(-1, 1)
+        vel0 = self.vel[..., self.e[:, 0], :]  # [ne x 3]
+        vel1 = self.vel[..., self.e[:, 1], :]
+        mVel0 = np.sum(vel0 * dispUnit, -1)[..., np.newaxis]  # [ne x 1]
+        mVel1 = np.sum(vel1 * dispUnit, -1)[..., np.newaxis]
         dVel = mVel1 - mVel0  # positive: elongating  # [ne x 1]
         FDamping = self.dampingSpring * dVel ** 3  # positive: contract
 
         self.FEdge = Fk + FDamping
 
     def computeFShrinkage(self):
-        Fss = []
-        for i, v in enumerate(self.v):
-            idsEdge = np.where((self.e == i)[:, 0] + (self.e == i)[:, 1])[0]
-            pairs = self.e[idsEdge]  # [? x 2] tuple of iv of incident edges
-            vsAdj = self.v[pairs[pairs != i]]  # [? x 3] pos of adjacent vertices
-            displacement = vsAdj - v[np.newaxis, :]  # [? x 3]
-            norm = np.sqrt(np.sum(displacement ** 2, 1)).reshape(-1, 1)  # [? x 1]
-            dispUnit = displacement / norm  # [? x 3]
-            Fs = np.sum(self.FEdge[idsEdge] * dispUnit, 0).reshape(1, 3)  # [1, 3]
-
-            velAdj = self.vel[pairs[pairs != i]]    # [? x 3] velocity of adjacent vertices
-            velDiff = (velAdj - self.vel[i].reshape(1, 3))  # [? x 3] difference of adjacent velocity
-            Fdamping = np.sum(velDiff * dispUnit * self.dampingSpring, 0).reshape(1, 3) # [1, 3]
-
-            Fs = Fs + Fdamping
-            Fss.append(Fs)
-        self.Fs = np.vstack(Fss)
+        # scatter the spring and damping forces of all edges to their end vertices in one pass
+        v0 = self.v[..., self.e[:, 0], :]  # [ne x 3]
+        v1 = self.v[..., self.e[:, 1], :]
+        displacement = v1 - v0  # [ne x 3] from v0 to v1
+        norm = np.sqrt(np.sum(displacement ** 2, -1))[..., np.newaxis]  # [ne x 1]
+        dispUnit = displacement / norm  # [ne x 3]
+        Fs = self.FEdge * dispUnit  # [ne x 3] on v0, the opposite on v1
+
+        velDiff = self.vel[..., self.e[:, 1], :] - self.vel[..., self.e[:, 0], :]  # [ne x 3] v1 relative to v0
+        Fdamping = velDiff * dispUnit * self.dampingSpring  # [ne x 3] same on both ends
+
+        FEnds = np.concatenate([Fs + Fdamping, Fdamping - Fs], -2)  # [2ne x 3] forces on e[:, 0] then e[:, 1]
+        Fs = np.bincount(self.iScatter, weights=FEnds.reshape(-1), minlength=self.v.size)    # sums in float64
+        self.Fs = Fs.astype(self.v.dtype, copy=False).reshape(self.v.shape)
 
     def computeFg(self):
-        self.Fg = np.copy(self.gUnit) * self.g
+        self.Fg = (self.gUnit * self.g).astype(self.dtype)
 
     def computeFn(self):
         Fk = np.zeros_like(self.v)
@@ -229,31 +518,20 @@ class Model(object):
         # post process the velocity to simulate the ground friction
 
         if self.ground == 2:
-            boolRows = (self.vel[:, 0] < 0) * self.maskContact
-            iRows = np.arange(self.v.shape[0])[boolRows]
-            iCols = np.zeros_like(iRows)
-            iCells = tuple(np.vstack([iRows, iCols]))
-            self.vel[iCells] = 0
+            boolRows = (self.vel[..., 0] < 0) * self.maskContact
+            self.vel[..., 0][boolRows] = 0
         elif self.ground == 1:
             boolRows = self.maskContact
-            iRows = np.arange(self.v.shape[0])[boolRows]
-            iCols = np.zeros_like(iRows)
-            iCells = tuple(np.vstack([iRows, iCols]))
-            self.vel[iCells] = 0
-            iCols = np.ones_like(iRows)
-            iCells = tuple(np.vstack([iRows, iCols]))
-            self.vel[iCells] = 0
+            self.vel[..., 0][boolRows] = 0
+            self.vel[..., 1][boolRows] = 0
         elif self.ground == 0:
             pass
 
     def computeVelGndCon(self):
         # post process velocity to simulate ground contact
 
-        boolRows = self.maskContact * (self.v[:, 2] < 0)
-        iRows = np.arange(self.v.shape[0])[boolRows]
-        iCols = np.ones_like(iRows) * 2
-        iCells = tuple(np.vstack([iRows, iCols]))
-        self.v[iCells] = 0
+        boolRows = self.maskContact * (self.v[..., 2] < 0)
+        self.v[..., 2][boolRows] = 0
 
     def computeVelDamping(self):
         # post process velocity for damping
@@ -274,11 +552,142 @@ class Model(object):
 
     # simulate with n steps
     def step(self, nSteps=1):
-        self.nSteps += nSteps
-        self.time += self.h
-        for i in range(nSteps):
-            self.computeGeometry()
-            self.computeF()
-            self.computeVel()
-            self.computePos()
+        if self.recorder is not None and nSteps > 1:
+            for i in range(nSteps):     # the frames are recorded between the steps
+                self.step()
+            return
+        if self.adaptive:
+            for i in range(nSteps):
+                self.stepAdaptive()
+        else:
+            self.nSteps += nSteps
+            self.time += self.h * nSteps
+            self.kernel.step(nSteps)
+        if self.recorder is not None:
+            self.recorder.record(self)
+
+    # simulate for a duration of time
+    def simulate(self, duration):
+        # input: duration: simulated time in seconds, the last step may overshoot it by less than one step
+        tEnd = self.time + duration
+        while self.time < tEnd:
+            self.step()
+
+    # adaptive stepping
+    def setAdaptive(self, adaptive=True, hMin=None, hMax=None, tolerance=1e-2):
+        # input: adaptive: if True, step sizes are chosen by step doubling, starting from the current h
+        #        hMin, hMax: bounds of the step size, h / 8 and h * 8 by default
+        #        tolerance: max position error of a step, relative to the shortest edge
+        self.adaptive = adaptive
+        self.hRef = self.h
+        self.hMin = self.h / 8 if hMin is None else hMin
+        self.hMax = self.h * 8 if hMax is None else hMax
+        self.tolerance = tolerance
+
+    def stepAdaptive(self):
+        # one step with error control
+        # the step is taken once with h and then twice with h / 2 from the same state, the difference estimates the
+        # error of the step; the two half steps are kept as the result, a step with a large or non-finite error is
+        # rolled back and retried with a smaller h, so an accepted step costs 3 substeps and one copy of the state
+        # return : the step size taken
+        self.stateAdaptive = state = self.getState(self.stateAdaptive)     # buffers reused from step to step
+        damping = self.damping
+        lScale = np.min(self.lInit)
+        try:
+            while True:
+                h = self.h
+                self.damping = 1 - (1 - damping) ** (h / self.hRef)    # the velocity discount is per step
+                self.kernel.step(1)
+                if self.vFull is None or self.vFull.shape != self.v.shape:
+                    self.vFull = np.empty_like(self.v)
+                np.copyto(self.vFull, self.v)
+
+                self.setState(state)
+                self.damping = 1 - (1 - damping) ** (h / 2 / self.hRef)
+                self.h = h / 2
+                self.kernel.step(2)
+                self.h = h
+                error = np.max(np.abs(self.v - self.vFull)) / lScale
+                if (np.isfinite(error) and error <= self.tolerance) or h <= self.hMin:
+                    break
+
+                self.setState(state)
+                factor = 0.9 * np.sqrt(self.tolerance / error) if np.isfinite(error) else 0.25
+                self.h = max(h * min(max(factor, 0.2), 0.5), self.hMin)
+        finally:
+            self.damping = damping
+
+        self.nSteps += 1
+        self.time += h
+
+        if np.any(self.maskContact != state['maskContact']):
+            self.h = max(h / 2, self.hMin)      # contact event
+        else:
+            factor = 0.9 * np.sqrt(self.tolerance / error) if error > 0 else 2
+            self.h = min(max(h * min(max(factor, 0.5), 2), self.hMin), self.hMax)
+        return h
+
+class BatchedModel(Model):
+    # nBatch copies of the same truss simulated together, the state is stacked along a leading axis
+    # v, vel: [nBatch x nv x 3], s, l, l0: [nBatch x ne x 1], the topology and the constants are shared
+    # the copies share the step size, so adaptive stepping, which picks it from the error of a model, is not supported
+
+    def __init__(self, model, nBatch=1):
+        # input: model: the Model to copy, its topology, constants, spaces and current positions are used
+        #        nBatch: number of copies
+        if model.adaptive:
+            raise ValueError('BatchedModel cannot copy an adaptive model, the copies would share its step sizes')
+
+        self.__dict__.update(model.__dict__)
+        self.nBatch = nBatch
+        self.recorder = None
+        self.kernel = model.kernel.bind(self)
+        self.attachProfiler()   # the copied wrappers call the phases of model
+        self.vInit = np.copy(model.v)   # positions all the copies start from [nv x 3]
+        self.stateInit = None           # state of the copies after reset, see resetCopies
+
+        self.reset()
+
+    def reset(self):
+        self.computeIncidence()
+        self.nSteps = 0
+        self.time = 0
 
+        self.v = np.repeat(self.vInit[np.newaxis], self.nBatch, 0)
+        self.s = np.zeros([self.nBatch, self.e.shape[0], 1], dtype=self.dtype)
+        self.pressure = 1
+        self.vel = np.zeros_like(self.v)
+
+        self.computeLength()
+        self.lInit = np.copy(self.l)
+        self.computeGeometry()
+        self.computeF()
+        self.stateInit = self.getState()
+
+    def resetCopies(self, mask):
+        # restore the copies selected by mask [nBatch] bool to their state after reset, the others are unchanged
+        for k in self.stateArrays:
+            x = getattr(self, k)
+            if x.ndim > 1:      # arrays shared by the copies, e.g. Fg, have no batch axis
+                x[mask] = self.stateInit[k][mask]
+
+    def setAdaptive(self, adaptive=True, hMin=None, hMax=None, tolerance=1e-2):
+        if adaptive:
+            raise ValueError('BatchedModel does not support adaptive stepping, the copies share the step size')
+        super().setAdaptive(adaptive, hMin, hMax, tolerance)
+
+    def computeIncidence(self):
+        # offset the scatter index of a single copy by the flat size of each copy
+        super().computeIncidence()
+        self.iScatter = (np.arange(self.nBatch)[:, np.newaxis] * self.vInit.size + self.iScatter).reshape(-1)
+
+    def setShrinkage(self, s=None, check=True):
+        # input: s: [nBatch x ne] one shrinkage ratio per copy, or [ne] / a number shared by all copies
+        if s is None:
+            s = self.s * 0
+        elif type(s) in [float, int]:
+            s = np.ones_like(self.s) * s
+        else:
+            s = np.array(s, dtype=self.dtype).reshape(-1, self.e.shape[0], 1) * np.ones_like(self.s)
+        assert (not check or np.all(s[..., 0] >= self.actionSpace.low) and np.all(s[..., 0] <= self.actionSpace.high))
+        self.s = s
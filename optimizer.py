@@ -1,7 +1,11 @@
 import os
-from pathos.multiprocessing import ProcessPool as Pool
-import multiprocessing
+import threading
 import numpy as np
+from evaluator import Evaluator
+from cache import FitnessCache
+from criterion import mergeStats
+from profiler import Profiler
+from surrogate import Surrogate
 rootPath = os.path.split(os.path.realpath(__file__))[0]
 
 
@@ -9,9 +13,77 @@ class Optimizer(object):
     def __init__(self, env=None):
         self.env = env
 
+        self.batch = False          # if True, the population is simulated in one batched rollout in this process
+        self.nWorkers = None        # number of worker processes, the number of cpus by default
+        self.chunkSize = None       # number of genes per task, None: the population is split evenly among workers
+        self.evaluator = None       # pool of worker processes, kept alive during maximize
+        self.cache = None           # fitness cache, see setCache
+        self.stats = None           # stats of the rollouts of the last evaluation
+
     def maximize(self):
         raise NotImplementedError('Please implement maximize function.')
 
+    def openEvaluator(self, nMax=1):
+        if not self.batch:
+            self.evaluator = Evaluator(self.env, self.nWorkers, nMax, self.chunkSize)
+
+    def closeEvaluator(self):
+        if self.evaluator is not None:
+            self.evaluator.close()
+            self.evaluator = None
+
+    def setCache(self, maxSize=100000, path=None):
+        # cache the fitnesses of the evaluated genes, genes found in the cache are not simulated again
+        # input: maxSize: max number of fitnesses kept in memory
+        #        path: sqlite file to keep the cache across runs, e.g. 'data/cache/fitness.sqlite', None: memory only
+        self.cache = FitnessCache(maxSize, path)
+        return self.cache
+
+    def evaluatePop(self, pop):
+        # input: pop: [n x len(lb)] genes in float
+        # return : fitnesses of the genes [n]
+        self.stats = {}
+        if self.cache is None:
+            return self.simulatePop(pop)
+
+        self.cache.setContext(self.env)
+        keys = self.cache.keys(pop)
+        fits = self.cache.get(keys)
+        iMisses = {}    # key: index of the first gene with the key among the misses
+        for i, (key, fit) in enumerate(zip(keys, fits)):
+            if fit is None and key not in iMisses:
+                iMisses[key] = i
+        if len(iMisses) > 0:
+            keysMissed = list(iMisses)
+            fitsMissed = self.simulatePop(pop[list(iMisses.values())])
+            self.cache.set(keysMissed, fitsMissed)
+            fitsMissed = dict(zip(keysMissed, fitsMissed))
+            fits = [fitsMissed[key] if fit is None else fit for key, fit in zip(keys, fits)]
+        return np.array(fits, dtype=np.float64)
+
+    def simulatePop(self, pop):
+        # input: pop: [n x len(lb)] genes in float
+        # return : fitnesses of the genes [n], simulated in batch, on the pool of workers or on a temporary one
+        if self.batch:
+            fits = self.env.criterion.batch(pop)
+            self.stats = self.env.criterion.popStats()
+        elif self.evaluator is not None:
+            fits = self.evaluator(pop)
+            self.stats = self.evaluator.stats
+        else:
+            with Evaluator(self.env, self.nWorkers, len(pop), self.chunkSize) as evaluator:
+                fits = evaluator(pop)
+                self.stats = evaluator.stats
+        return fits
+
+    def printStats(self):
+        if self.stats:
+            nStepsMax = self.stats['nSteps'] + self.stats['nStepsSaved']
+            print('steps saved: {} / {}, diverged: {}, converged: {}'.format(
+                self.stats['nStepsSaved'], nStepsMax, self.stats['nDiverged'], self.stats['nConverged']))
+            if self.stats.get('profile'):
+                Profiler.printReport(self.stats['profile'])
+
 
 class EvolutionAlgorithm(Optimizer):
     def __init__(self, env=None, nGenMax=50, nPop=40, nHero=3,
@@ -41,10 +113,26 @@ class EvolutionAlgorithm(Optimizer):
         self.preTrained = False     # if True, a gene will be loaded into population under ``load`` function
         self.policyName = None
 
+        # checkpoint
+        self.checkpointPath = None      # if set, maximize writes a checkpoint to this .npz file
+        self.checkpointInterval = 1     # number of generations between two checkpoints
+        self.checkpointThread = None    # thread writing the last checkpoint
+
+        # surrogate pre-screening, see setSurrogate
+        self.surrogate = None
+        self.nPool = 4                  # number of populations bred per generation as candidates
+        self.ratio = 0.5                # max share of the population simulated per generation
+        self.exploration = 0.2          # share of the simulated candidates picked at random
+        self.predictions = None         # predicted fitnesses of the first genes of the population, if screened
+        self.nEvaluated = 0             # number of genes evaluated, simulated or found in the archive
+        self.nSimulated = 0             # number of genes simulated
+
         self.reset()
 
     def reset(self):
         self.nGen = 0
+        self.nEvaluated = 0
+        self.nSimulated = 0
         self.oldPop = None
         self.initPop()
 
@@ -81,11 +169,78 @@ class EvolutionAlgorithm(Optimizer):
         assert( (pop == pop.astype(np.int)).all() )
         return pop
 
+    def setSurrogate(self, nPool=4, ratio=0.5, exploration=0.2, nTrainMax=1000):
+        # pre-screen the offspring with a regression of the fitness trained on all the simulated genes, see Surrogate
+        # each generation, nPool populations are bred from the survivors, the genes of the pool already simulated
+        # keep their fitness from the archive of the surrogate, and at most ratio * nPop new genes are simulated: the
+        # best predicted ones, and a share exploration of random ones
+        # the archive is not written to the checkpoints, a resumed run breeds without screening until it is refilled
+        # input: nTrainMax: max number of genes the surrogate is trained on
+        self.nPool = nPool
+        self.ratio = ratio
+        self.exploration = exploration
+        self.surrogate = Surrogate(self.lb, self.ub, nTrainMax)
+        return self.surrogate
+
+    def screen(self):
+        # breed the next population from the survivors of select, in place of crossOver, mutate and regenerate
+        # the first of the nPool populations bred keeps its genes already simulated, and its new genes are replaced
+        # by the ones picked by the surrogate among the new genes of all the pool
+        survivors = self.pop
+        fitsSurvivors = self.fits
+        pool = []
+        for i in range(self.nPool):
+            self.pop = np.copy(survivors)
+            self.fits = np.copy(fitsSurvivors)
+            self.crossOver()
+            self.mutate()
+            self.regenerate()
+            pool.append(self.pop)
+        first = pool[0]
+        isNew = np.isnan(self.surrogate.lookup(self.popIntToFloat(first)))
+        pool = np.unique(np.concatenate(pool), axis=0)     # the candidates are ranked once, however often bred
+        poolNew = pool[np.isnan(self.surrogate.lookup(self.popIntToFloat(pool)))]
+
+        nSimulateMax = int(np.ceil(self.ratio * self.nPop))
+        nSimulate = min(nSimulateMax, np.count_nonzero(isNew), len(poolNew))
+        nExplore = int(round(self.exploration * nSimulate))
+        predictions = self.surrogate.predict(self.popIntToFloat(poolNew))
+        order = np.random.permutation(len(poolNew))
+        iExploit = order[nExplore:][np.argsort(predictions[order[nExplore:]])[::-1][:nSimulate - nExplore]]
+        iSimulate = np.concatenate([iExploit, order[:nExplore]])
+
+        # the genes to simulate first, the population is refilled up to nPop with the best of the old one like
+        # regenerate, which was evaluated by the last generation, so only the screened genes are simulated; it also
+        # fills the places of the new genes bred several times, which are simulated once
+        nFill = self.nPop - nSimulate - np.count_nonzero(np.invert(isNew))
+        self.pop = np.concatenate([poolNew[iSimulate], first[np.invert(isNew)], self.oldPop[:nFill]])
+        self.predictions = predictions[iSimulate]
+        assert(len(self.pop) == self.nPop)
+        assert(np.count_nonzero(np.isnan(self.surrogate.lookup(self.popIntToFloat(self.pop)))) <= nSimulateMax)
+
     def evaluate(self, disp=False):
         popFloat = self.popIntToFloat(self.pop)
-        pops = [p for p in popFloat]
-        with Pool(multiprocessing.cpu_count()) as p:
-            self.fits = np.array(p.map(self.env.criterion, pops))
+        if self.surrogate is None:
+            self.fits = self.evaluatePop(popFloat)
+            nSimulated = len(popFloat)
+        else:
+            # only the genes missing from the archive are simulated
+            self.fits = self.surrogate.lookup(popFloat)
+            isNew = np.isnan(self.fits)
+            nSimulated = np.count_nonzero(isNew)
+            if nSimulated > 0:
+                self.fits[isNew] = self.evaluatePop(popFloat[isNew])
+                self.surrogate.add(popFloat[isNew], self.fits[isNew])
+        self.nEvaluated += len(popFloat)
+        self.nSimulated += nSimulated
+
+        correlation = None      # accuracy of the surrogate on the screened genes
+        if self.predictions is not None:
+            fitsPredicted = self.fits[:len(self.predictions)]
+            isFinite = np.isfinite(fitsPredicted)
+            correlation = Surrogate.rankCorrelation(self.predictions, fitsPredicted)
+            error = np.mean(np.abs(self.predictions - fitsPredicted)[isFinite]) if np.any(isFinite) else np.nan
+            self.predictions = None
 
         meanFit = np.mean(self.fits)
         maxFit = np.max(self.fits)
@@ -96,6 +251,16 @@ class EvolutionAlgorithm(Optimizer):
             print('mean: ', meanFit)
             print('max: ', maxFit)
             print('min: ', minFit)
+            if self.cache is not None:
+                print('cache hits: {} / {}, total hit rate: {:.3f}'.format(
+                    self.cache.nHits, self.cache.nLookups, self.cache.hitRate(total=True)))
+            if self.surrogate is not None:
+                print('simulated: {} / {}, saved in total: {} / {}'.format(
+                    nSimulated, len(popFloat), self.nEvaluated - self.nSimulated, self.nEvaluated))
+                if correlation is not None:
+                    print('surrogate rank correlation: {:.3f}, mean absolute error: {:.4g}'.format(
+                        correlation, error))
+            self.printStats()
 
     def sort(self):
         order = np.argsort(self.fits)[::-1]
@@ -108,10 +273,14 @@ class EvolutionAlgorithm(Optimizer):
         self.fits = self.fits[order]
 
     def select(self):
-        fitMin = np.min(self.fits)
-        fitMax = np.max(self.fits)
+        fitsFinite = self.fits[np.isfinite(self.fits)]    # diverged rollouts score -inf
+        if len(fitsFinite) == 0:
+            fitsFinite = np.zeros(1)
+        fitMin = np.min(fitsFinite)
+        fitMax = np.max(fitsFinite)
         fitInterval = fitMax - fitMin + 1e-8
         distance = (fitMax - self.fits) / fitInterval  # normalized distance of the fitness to the max fitness
+        distance = np.clip(distance, 0, 1)
         pbDie = distance ** 3 * self.mortality
         pbDie[:self.nHero] = 0
 
@@ -156,17 +325,339 @@ class EvolutionAlgorithm(Optimizer):
         self.pop = np.append(self.pop, self.oldPop[:nDead], axis=0)
         self.fits = np.pad(self.fits, (0, nDead), 'wrap')
 
-    def maximize(self, nSteps=1):
-        self.initPop()
-        if self.preTrained:
-            self.load(self.policyName)
-        self.evaluate(True)
-        self.sort()
-        for i in range(nSteps):
-            self.nGen += 1
-            self.select()
-            self.crossOver()
-            self.mutate()
-            self.regenerate()
-            self.evaluate(True)
+    # checkpoint
+    hyperparameters = ['nPop', 'nHero', 'mortality', 'pbCross', 'pbMut', 'pbCrossDig', 'pbMutDig', 'nStages']
+
+    def saveCheckpoint(self, path, iStep=0):
+        # write the population, the fitnesses, the generation counter, the random state and the hyperparameters
+        # the file is written by a background thread to a temporary file which then replaces path atomically
+        # input: iStep: number of generations of the running maximize already done
+        rngName, rngKeys, rngPos, rngHasGauss, rngCachedGaussian = np.random.get_state()
+        data = {
+            'pop': np.copy(self.pop),
+            'fits': np.copy(self.fits),
+            'oldPop': np.copy(self.pop[:0] if self.oldPop is None else self.oldPop),
+            'nGen': self.nGen,
+            'iStep': iStep,
+            'rngKeys': rngKeys,
+            'rngPos': rngPos,
+            'rngHasGauss': rngHasGauss,
+            'rngCachedGaussian': rngCachedGaussian,
+        }
+        data.update({k: getattr(self, k) for k in self.hyperparameters})
+
+        self.waitCheckpoint()
+        self.checkpointThread = threading.Thread(target=self.writeCheckpoint, args=(path, data))
+        self.checkpointThread.start()
+
+    def writeCheckpoint(self, path, data):
+        pathTemp = path + '.tmp'
+        with open(pathTemp, 'wb') as f:
+            np.savez(f, **data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pathTemp, path)
+
+    def waitCheckpoint(self):
+        if self.checkpointThread is not None:
+            self.checkpointThread.join()
+            self.checkpointThread = None
+
+    def loadCheckpoint(self, path):
+        # restore the state saved by saveCheckpoint
+        # return : iStep: number of generations of the interrupted maximize already done
+        data = np.load(path)
+        for k in self.hyperparameters:
+            setattr(self, k, data[k].item())
+        self.interval = (self.ub - self.lb) / self.nStages
+        self.ubInt = np.ones_like(self.ub) * (self.nStages + 1)
+
+        self.pop = data['pop']
+        self.fits = data['fits']
+        self.oldPop = data['oldPop'] if len(data['oldPop']) > 0 else None
+        self.nGen = data['nGen'].item()
+        np.random.set_state(('MT19937', data['rngKeys'], data['rngPos'].item(),
+                             data['rngHasGauss'].item(), data['rngCachedGaussian'].item()))
+        return data['iStep'].item()
+
+    def maximize(self, nSteps=1, resume=None):
+        # input: nSteps: number of generations
+        #        resume: path of a checkpoint, the interrupted run continues exactly where the checkpoint was written
+        self.openEvaluator(self.nPop)
+        try:
+            if resume is None:
+                iStart = 0
+                self.initPop()
+                if self.preTrained:
+                    self.load(self.policyName)
+                self.evaluate(True)
+                self.sort()
+            else:
+                iStart = self.loadCheckpoint(resume)
+
+            for i in range(iStart, nSteps):
+                self.nGen += 1
+                self.select()
+                if self.surrogate is not None and len(self.surrogate) >= self.nPop and self.surrogate.fit():
+                    self.screen()
+                else:
+                    self.crossOver()
+                    self.mutate()
+                    self.regenerate()
+                self.evaluate(True)
+                if self.checkpointPath is not None and ((i + 1) % self.checkpointInterval == 0 or i + 1 == nSteps):
+                    self.saveCheckpoint(self.checkpointPath, i + 1)
+        finally:
+            self.closeEvaluator()
+            self.waitCheckpoint()
+        return self.getSurvivor(0)
+
+
+class CMAES(Optimizer):
+    # covariance matrix adaptation evolution strategy in the continuous action box, with IPOP / BIPOP restarts
+    # the genes are sampled in the box normalized to [0, 1], a sample outside is evaluated at its projection on the
+    # box and its fitness is lowered by penaltyBound times its squared distance to it, so the mean stays inside
+    # the samples of a generation are drawn at once and evaluated by Optimizer.evaluatePop, in batch or on workers
+    # with many genes, e.g. the 641 edges of 8x8x1, a full covariance matrix is learned too slowly for the budgets of
+    # a few thousand rollouts, the diagonal variant (sep-CMA-ES) adapts the variance of each gene in O(n) instead
+
+    def __init__(self, env=None, nPop=None, sigma0=0.3, restarts='bipop', nRestartsMax=9, diagonal=None, seed=None):
+        # input: nPop: population size of the first run of each maximize, 4 + 3 ln(n) by default, kept in nPopConfig
+        #        sigma0: initial step size, relative to the width of the box
+        #        restarts: None, 'ipop': the population doubles at each restart, 'bipop': the doubling runs alternate
+        #                  with runs of small populations and step sizes, whichever used fewer evaluations
+        #        nRestartsMax: max number of restarts of a maximize
+        #        diagonal: if True, the covariance matrix is diagonal, None: if there are more than 100 genes
+        super().__init__(env)
+        assert(restarts in [None, 'ipop', 'bipop'])
+        self.lb = self.env.model.actionSpace.low.astype(np.float64)
+        self.ub = self.env.model.actionSpace.high.astype(np.float64)
+        self.n = len(self.lb)
+        self.nPopConfig = 4 + int(3 * np.log(self.n)) if nPop is None else nPop
+        self.nPop = self.nPopConfig
+        self.sigma0 = sigma0
+        self.restarts = restarts
+        self.nRestartsMax = nRestartsMax
+        self.diagonal = self.n > 100 if diagonal is None else diagonal
+        self.rng = np.random.default_rng(seed)
+
+        # stopping criteria of a run
+        self.tolFun = 1e-8          # range of the best fitnesses of the last generations
+        self.tolX = 1e-8            # step size times the standard deviations, in the normalized box
+        self.conditionMax = 1e14    # condition number of the covariance matrix
+        self.penaltyBound = 0.1     # penalty of the squared normalized distance to the box, relative to the
+                                    # interquartile range of the fitnesses of the generation
+
+        # state of the run
+        self.nPopInit = None        # population of the first run, and the smallest of the BIPOP runs
+        self.nPopLarge = None       # population of the last run of the doubling regime
+        self.regime = 0             # 0: doubling regime, 1: small population regime of BIPOP
+        self.mean = None            # [n] in the normalized box
+        self.sigma = None
+        self.C = None               # [n x n] covariance matrix, [n] if diagonal
+        self.B = None               # eigenvectors of C, None if diagonal
+        self.D = None               # square roots of the eigenvalues of C
+        self.pc = None              # evolution path of C
+        self.ps = None              # evolution path of sigma
+        self.nGenRun = None         # generations of the run
+        self.iEigen = None          # generation of the last eigendecomposition
+        self.fitsBestRun = None     # best fitness of each generation of the run
+
+        # results
+        self.pop = None             # genes of the last generation, sorted by decreasing fitness
+        self.fits = None
+        self.xBest = None           # best gene found
+        self.fitBest = -np.inf
+        self.nGen = 0
+        self.nEvaluations = 0
+        self.nEvaluationsRegimes = None     # evaluations of the large and small population regimes of BIPOP
+        self.meanInit = None        # if set, the initial mean of the runs, e.g. a pre-trained policy, see load
+        self.policyName = None
+
+        self.reset()
+
+    def reset(self):
+        self.lb = self.env.model.actionSpace.low.astype(np.float64)
+        self.ub = self.env.model.actionSpace.high.astype(np.float64)
+        self.nGen = 0
+        self.nEvaluations = 0
+        self.nEvaluationsRegimes = [0, 0]
+        self.xBest = None
+        self.fitBest = -np.inf
+        self.startRun(self.nPop, self.sigma0)
+
+    def startRun(self, nPop, sigma):
+        # set up the parameters and the state of a run of population nPop
+        n = self.n
+        self.nPop = nPop
+        self.mu = nPop // 2
+        weights = np.log((nPop + 1) / 2) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights / np.sum(weights)
+        self.muEff = 1 / np.sum(self.weights ** 2)
+
+        self.cc = (4 + self.muEff / n) / (n + 4 + 2 * self.muEff / n)
+        self.cs = (self.muEff + 2) / (n + self.muEff + 5)
+        self.c1 = 2 / ((n + 1.3) ** 2 + self.muEff)
+        self.cmu = min(1 - self.c1, 2 * (self.muEff - 2 + 1 / self.muEff) / ((n + 2) ** 2 + self.muEff))
+        if self.diagonal:
+            # the n variances are learned faster than the n ^ 2 entries of a full matrix
+            self.c1 *= (n + 2) / 3
+            self.cmu = min(1 - self.c1, self.cmu * (n + 2) / 3)
+        self.ds = 1 + 2 * max(0, np.sqrt((self.muEff - 1) / (n + 1)) - 1) + self.cs
+        self.chiN = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))     # E ||N(0, I)||
+
+        if self.meanInit is not None:
+            self.mean = (self.meanInit - self.lb) / (self.ub - self.lb)
+        else:
+            self.mean = self.rng.uniform(0.2, 0.8, n)
+        self.sigma = sigma
+        self.C = np.ones(n) if self.diagonal else np.eye(n)
+        self.B = None if self.diagonal else np.eye(n)
+        self.D = np.ones(n)
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        self.nGenRun = 0
+        self.iEigen = 0
+        self.fitsBestRun = []
+
+    def getSurvivor(self, i=0):
+        # return : the best gene found for i = 0, else the i-th best gene of the last generation
+        if i == 0 and self.xBest is not None:
+            return self.xBest
+        return self.pop[i]
+
+    def load(self, policyName):
+        # start the runs from a pre-trained gene
+        self.policyName = policyName
+        name = os.path.join(rootPath, 'data/agent/', policyName + '.npy')
+        p = np.load(name, allow_pickle=True).astype(np.float64)
+        assert(p.shape == self.lb.shape)
+        self.meanInit = np.clip(p, self.lb, self.ub)
+        self.mean = (self.meanInit - self.lb) / (self.ub - self.lb)
+
+    def sample(self):
+        # return : z [nPop x n] standard normal samples, y [nPop x n] samples in the normalized box, unbounded
+        z = self.rng.standard_normal((self.nPop, self.n))
+        if self.diagonal:
+            return z, self.mean + self.sigma * z * self.D
+        y = self.mean + self.sigma * (z * self.D) @ self.B.T
+        return z, y
+
+    def evaluate(self, y, disp=False):
+        # return : the penalized fitnesses of the normalized samples y
+        yBounded = np.clip(y, 0, 1)
+        pop = self.lb + yBounded * (self.ub - self.lb)
+        fits = self.evaluatePop(pop)
+        self.nEvaluations += len(pop)
+
+        iBest = np.argmax(fits)
+        if fits[iBest] > self.fitBest:
+            self.fitBest = fits[iBest]
+            self.xBest = pop[iBest]
+        order = np.argsort(fits)[::-1]
+        self.pop = pop[order]
+        self.fits = fits[order]
+
+        if disp:
+            print('nGen: {}, run population: {}, sigma: {:.4f}, evaluations: {}'.format(
+                self.nGen, self.nPop, self.sigma, self.nEvaluations))
+            print('max: ', self.fits[0])
+            print('best: ', self.fitBest)
+            if self.cache is not None:
+                print('cache hits: {} / {}, total hit rate: {:.3f}'.format(
+                    self.cache.nHits, self.cache.nLookups, self.cache.hitRate(total=True)))
+            self.printStats()
+        finite = fits[np.isfinite(fits)]
+        spread = np.subtract(*np.percentile(finite, [75, 25])) if len(finite) > 0 else 0
+        return fits - self.penaltyBound * spread * np.sum((y - yBounded) ** 2, 1)
+
+    def update(self, z, y, fits):
+        # update the mean, the evolution paths, the covariance matrix and the step size from a generation
+        n = self.n
+        order = np.argsort(-fits, kind='stable')[:self.mu]     # -inf, i.e. diverged, is ranked last
+        zSel = z[order]
+        ySel = (y[order] - self.mean) / self.sigma  # [mu x n] steps of the selected samples, ~ N(0, C)
+
+        self.mean = self.mean + self.sigma * (self.weights @ ySel)
+        zMean = self.weights @ zSel
+        zMean = zMean if self.diagonal else self.B @ zMean
+        self.ps = (1 - self.cs) * self.ps + np.sqrt(self.cs * (2 - self.cs) * self.muEff) * zMean
+        normPs = np.linalg.norm(self.ps)
+        hSigma = normPs / np.sqrt(1 - (1 - self.cs) ** (2 * (self.nGenRun + 1))) < (1.4 + 2 / (n + 1)) * self.chiN
+        self.pc = (1 - self.cc) * self.pc + hSigma * np.sqrt(self.cc * (2 - self.cc) * self.muEff) * \
+            (self.weights @ ySel)
+
+        decay = 1 - self.c1 - self.cmu + (1 - hSigma) * self.c1 * self.cc * (2 - self.cc)
+        if self.diagonal:
+            self.C = decay * self.C + self.c1 * self.pc ** 2 + self.cmu * (self.weights @ ySel ** 2)
+        else:
+            rankMu = (ySel * self.weights[:, np.newaxis]).T @ ySel
+            self.C = decay * self.C + self.c1 * np.outer(self.pc, self.pc) + self.cmu * rankMu
+        self.sigma *= np.exp(min(self.cs / self.ds * (normPs / self.chiN - 1), 1))
+
+        # the eigendecomposition is amortized over the generations, O(n ^ 3) every O(n / nPop) generations
+        self.nGenRun += 1
+        if self.diagonal:
+            self.D = np.sqrt(self.C)
+        elif self.nGenRun - self.iEigen > self.nPop / (self.c1 + self.cmu) / n / 10:
+            self.iEigen = self.nGenRun
+            self.C = np.triu(self.C) + np.triu(self.C, 1).T
+            eigenvalues, self.B = np.linalg.eigh(self.C)
+            self.D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+
+    def isConverged(self):
+        # return : whether the run stopped progressing
+        nHistory = 10 + int(np.ceil(30 * self.n / self.nPop))
+        fitsBest = np.array(self.fitsBestRun[-nHistory:])
+        if len(self.fitsBestRun) >= nHistory and np.all(np.isfinite(fitsBest)) and \
+                np.ptp(fitsBest) < self.tolFun and np.ptp(self.fits[np.isfinite(self.fits)]) < self.tolFun:
+            return True
+        if self.sigma * max(np.max(self.D), np.max(np.abs(self.pc))) < self.tolX:
+            return True
+        if np.max(self.D) > np.sqrt(self.conditionMax) * np.min(self.D):
+            return True
+        return False
+
+    def restart(self):
+        # start a new run, IPOP doubles the population, BIPOP alternates with runs of small populations
+        if self.restarts == 'bipop' and self.nEvaluationsRegimes[1] < self.nEvaluationsRegimes[0]:
+            nPop = int(self.nPopInit * (0.5 * self.nPopLarge / self.nPopInit) ** (self.rng.uniform() ** 2))
+            self.regime = 1
+            self.startRun(max(nPop, self.nPopInit), self.sigma0 * 10 ** (-2 * self.rng.uniform()))
+        else:
+            self.nPopLarge *= 2
+            self.regime = 0
+            self.startRun(self.nPopLarge, self.sigma0)
+
+    def maximize(self, nSteps=1, nEvaluationsMax=None):
+        # input: nSteps: number of generations, over all the runs
+        #        nEvaluationsMax: if set, the optimization also stops after this number of evaluations
+        # return : the best gene found
+        self.nPop = self.nPopConfig     # the restarts of a previous maximize enlarged nPop
+        self.nPopInit = self.nPop
+        self.nPopLarge = self.nPop
+        self.regime = 0
+        self.nEvaluationsRegimes = [0, 0]
+        self.startRun(self.nPop, self.sigma0)
+        nRestarts = 0
+        # the doubling runs reach nPopInit * 2 ^ nRestartsMax, the small runs of BIPOP stay below half of the last one,
+        # the shared buffers are allocated for it at once so that the restarts do not rebuild the pool of workers
+        self.openEvaluator(self.nPop * 2 ** self.nRestartsMax if self.restarts is not None else self.nPop)
+        try:
+            for i in range(nSteps):
+                if nEvaluationsMax is not None and self.nEvaluations >= nEvaluationsMax:
+                    break
+                z, y = self.sample()
+                self.nEvaluationsRegimes[self.regime] += len(y)
+                fits = self.evaluate(y, True)
+                self.update(z, y, fits)
+                self.fitsBestRun.append(self.fits[0])
+                self.nGen += 1
+
+                if self.isConverged() and self.restarts is not None and nRestarts < self.nRestartsMax:
+                    self.restart()
+                    nRestarts += 1
+                    print('restart {}: population {}, sigma {:.4f}'.format(nRestarts, self.nPop, self.sigma))
+        finally:
+            self.closeEvaluator()
         return self.getSurvivor(0)
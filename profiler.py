@@ -0,0 +1,86 @@
+import time
+import weakref
+import tracemalloc
+
+
+class Profiler(object):
+    # cumulative wall time and number of calls of methods of objects, e.g. the phases of Model.step
+    # attach replaces the methods of the instances by timed wrappers and detach restores them, so an object without
+    # profiler runs its original methods at no cost
+    # nested phases are timed inclusively, e.g. 'step' includes 'computeF'
+    # with allocations set, the peak of the memory traced by tracemalloc during each call is summed as well,
+    # tracing slows the simulation down and the peaks of nested phases are approximate
+
+    def __init__(self, allocations=False):
+        self.allocations = allocations
+        self.records = {}       # label: [time in seconds, number of calls, bytes allocated]
+        self.attached = weakref.WeakValueDictionary()   # (id of the object, name of the method): object
+
+    def attach(self, obj, names, prefix=''):
+        # input: obj: the instance whose methods are timed
+        #        names: names of the methods, the ones of the class are wrapped, also if obj was a copy of a profiled
+        #               object, e.g. a BatchedModel
+        #        prefix: prefix of the labels of the methods in the report
+        if self.allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        for name in names:
+            method = getattr(type(obj), name).__get__(obj)
+            obj.__dict__[name] = self.wrap(method, prefix + name)
+            self.attached[(id(obj), name)] = obj
+
+    def detach(self):
+        for (_, name), obj in list(self.attached.items()):
+            obj.__dict__.pop(name, None)
+        self.attached = weakref.WeakValueDictionary()
+
+    def wrap(self, method, label):
+        record = self.records.setdefault(label, [0.0, 0, 0])
+
+        if not self.allocations:
+            def wrapper(*args, **kwargs):
+                t = time.perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    record[0] += time.perf_counter() - t
+                    record[1] += 1
+            return wrapper
+
+        def wrapperAllocations(*args, **kwargs):
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            t = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                record[0] += time.perf_counter() - t
+                record[1] += 1
+                record[2] += max(tracemalloc.get_traced_memory()[1] - memory, 0)
+        return wrapperAllocations
+
+    def getReport(self):
+        # return : {label: {'time': seconds, 'calls': number, 'bytes': allocated if allocations is set}}
+        report = {}
+        for label, (t, nCalls, nBytes) in self.records.items():
+            if nCalls == 0:
+                continue
+            report[label] = {'time': t, 'calls': nCalls}
+            if self.allocations:
+                report[label]['bytes'] = nBytes
+        return report
+
+    def popReport(self):
+        # return : the report, the records are then cleared
+        report = self.getReport()
+        for record in self.records.values():
+            record[:] = [0.0, 0, 0]     # in place, the wrappers keep references to the records
+        return report
+
+    @staticmethod
+    def printReport(report):
+        # print the phases by decreasing time, e.g. a report merged over the workers by criterion.mergeStats
+        print('{:28s} {:>10s} {:>10s} {:>12s} {:>12s}'.format('phase', 'time (s)', 'calls', 'us / call', 'MB'))
+        for label, record in sorted(report.items(), key=lambda item: -item[1]['time']):
+            print('{:28s} {:10.4f} {:10d} {:12.2f} {:>12s}'.format(
+                label, record['time'], record['calls'], record['time'] / max(record['calls'], 1) * 1e6,
+                '{:.2f}'.format(record['bytes'] / 2 ** 20) if 'bytes' in record else '-'))
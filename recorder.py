@@ -0,0 +1,126 @@
+import os
+import json
+import numpy as np
+
+
+class Recorder(object):
+    # records the trajectory of a model into preallocated memory-mapped .npy files, read back with Recording
+    # a frame is written every stride steps, the memory is bounded by nFrames: when full, the recording stops,
+    # or, with ring set, the oldest frames are overwritten
+    # files: <path>.json metadata, <path>.e.npy edges, <path>.time.npy times and <path>.<field>.npy per field
+
+    fieldsAll = ['v', 'vel', 's']
+
+    def __init__(self, path, nFrames=1000, stride=1, dtype='float32', fields=('v',), ring=False):
+        # input: path: path of the recording without extension
+        #        nFrames: max number of frames kept
+        #        stride: number of steps between two frames
+        #        dtype: 'float16' or 'float32' storage of the fields
+        #        fields: recorded arrays of the model among fieldsAll
+        #        ring: if True, keep the last nFrames frames instead of the first ones
+        assert all(field in Recorder.fieldsAll for field in fields)
+        self.path = path
+        self.nFrames = nFrames
+        self.stride = stride
+        self.dtype = np.dtype(dtype)
+        self.fields = list(fields)
+        self.ring = ring
+
+        self.arrays = {}        # field: memory-mapped [nFrames x ...]
+        self.times = None       # memory-mapped [nFrames]
+        self.metadata = None
+        self.iFrame = 0         # number of frames recorded so far, including the overwritten ones
+        self.nStepsLast = None  # model.nSteps at the last frame
+
+    def open(self, model):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        for field in self.fields:
+            shape = (self.nFrames,) + getattr(model, field).shape
+            self.arrays[field] = np.lib.format.open_memmap(self.getFileName(field), mode='w+',
+                                                           dtype=self.dtype, shape=shape)
+        self.times = np.lib.format.open_memmap(self.getFileName('time'), mode='w+', dtype=np.float64,
+                                               shape=(self.nFrames,))
+        np.save(self.getFileName('e'), model.e)
+
+        self.metadata = {
+            'modelName': model.modelName,
+            'h': model.h,
+            'stride': self.stride,
+            'nFrames': self.nFrames,
+            'dtype': self.dtype.name,
+            'fields': self.fields,
+            'ring': self.ring,
+            'nRecorded': 0,
+        }
+        self.iFrame = 0
+        self.nStepsLast = None
+        self.record(model)
+
+    def getFileName(self, field):
+        return '{}.{}.npy'.format(self.path, field)
+
+    def record(self, model):
+        # called by Model.step after each step, writes a frame every stride steps
+        if self.nStepsLast is not None and 0 <= model.nSteps - self.nStepsLast < self.stride:
+            return
+        if self.iFrame >= self.nFrames and not self.ring:
+            return
+        i = self.iFrame % self.nFrames
+        for field, array in self.arrays.items():
+            array[i] = getattr(model, field)
+        self.times[i] = model.time
+        self.iFrame += 1
+        self.nStepsLast = model.nSteps
+
+    def flush(self):
+        # write the recorded frames and the metadata to disk, the recording can then be read while recording
+        for array in self.arrays.values():
+            array.flush()
+        self.times.flush()
+        self.metadata['nRecorded'] = self.iFrame
+        with open(self.path + '.json', 'w') as f:
+            json.dump(self.metadata, f)
+
+    def close(self):
+        self.flush()
+        self.arrays = {}
+        self.times = None
+
+
+class Recording(object):
+    # a trajectory written by Recorder, memory-mapped so that long recordings are read lazily
+    # the frames are indexed in chronological order, also after a ring buffer wrapped around
+
+    def __init__(self, path):
+        with open(path + '.json') as f:
+            self.metadata = json.load(f)
+        self.path = path
+        self.modelName = self.metadata['modelName']
+        self.stride = self.metadata['stride']
+        self.e = np.load(path + '.e.npy')
+        self.arrays = {field: np.load('{}.{}.npy'.format(path, field), mmap_mode='r')
+                       for field in self.metadata['fields']}
+        self.times = np.load(path + '.time.npy', mmap_mode='r')
+
+        nRecorded = self.metadata['nRecorded']
+        nFrames = self.metadata['nFrames']
+        self.nFrames = min(nRecorded, nFrames)
+        self.iStart = nRecorded % nFrames if nRecorded > nFrames else 0    # oldest frame of a wrapped ring
+
+    def __len__(self):
+        return self.nFrames
+
+    def getIndex(self, i):
+        return (self.iStart + i) % self.metadata['nFrames']
+
+    def getFrame(self, i, field='v'):
+        # return : the field of the i-th frame in float64
+        return np.asarray(self.arrays[field][self.getIndex(i)], dtype=np.float64)
+
+    def getTime(self, i):
+        return float(self.times[self.getIndex(i)])
+
+    def getTimes(self):
+        # return : [len] times of all the frames
+        return np.asarray(self.times[self.getIndex(np.arange(self.nFrames))])
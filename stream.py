@@ -0,0 +1,276 @@
+import zlib
+import socket
+import struct
+import threading
+import numpy as np
+
+# binary streaming of the positions of a model, e.g. to a web front end
+# every message is prefixed by its length as uint32, all the values are little-endian
+# topology: uint8 type 0, uint32 nv, uint32 ne, uint8 bytes per index, [ne x 2] edges
+# frame:    uint8 type 1, uint32 iFrame, float64 time, uint8 encoding, uint8 flags,
+#           for uint16 encoding: float32 [2 x 3] box (lo, hi), then the [nv x 3] positions, zlib compressed if flagged
+# with the uint16 encoding, the positions are quantized in the box and a delta frame sends the difference of the
+# quantized positions to the previous frame of the client, wrapping around, so the decoding is exact
+
+TOPOLOGY = 0
+FRAME = 1
+
+encodings = {'float32': 0, 'float16': 1, 'uint16': 2}
+FLAG_DELTA = 1
+FLAG_COMPRESSED = 2
+
+headerLength = struct.Struct('<I')
+headerTopology = struct.Struct('<BIIB')
+headerFrame = struct.Struct('<BIdBB')
+headerBox = struct.Struct('<6f')
+
+
+class FrameEncoder(object):
+    # encodes the positions of one stream, the state of the delta encoding is per client
+
+    def __init__(self, encoding='uint16', delta=True, keyInterval=100, compress=True):
+        # input: encoding: 'float32', 'float16' or 'uint16', quantized in a bounding box
+        #        delta: if True, uint16 frames are sent as differences to the previous frame
+        #        keyInterval: number of frames between two full frames
+        #        compress: if True, the positions are compressed with zlib
+        assert(encoding in encodings)
+        self.encoding = encoding
+        self.delta = delta and encoding == 'uint16'
+        self.keyInterval = keyInterval
+        self.compress = compress
+
+        self.iFrame = 0
+        self.box = None     # [2 x 3] float32 quantization box of the last key frame
+        self.qLast = None   # quantized positions of the last frame
+
+    @staticmethod
+    def encodeTopology(e, nv):
+        e = np.asarray(e)
+        dtype = np.dtype('<u2') if nv <= 0xffff else np.dtype('<u4')
+        return headerTopology.pack(TOPOLOGY, nv, len(e), dtype.itemsize) + e.astype(dtype).tobytes()
+
+    def encodeFrame(self, v, time=0.0):
+        # input: v: [nv x 3] positions
+        flags = 0
+        if self.encoding == 'float32':
+            data = np.ascontiguousarray(v, dtype='<f4').tobytes()
+        elif self.encoding == 'float16':
+            data = np.ascontiguousarray(v, dtype='<f2').tobytes()
+        else:
+            q, isDelta = self.quantize(v)
+            if isDelta:
+                flags |= FLAG_DELTA
+                data = (q - self.qLast).tobytes()   # wraps around in uint16
+            else:
+                data = headerBox.pack(*self.box.reshape(-1)) + q.tobytes()
+            self.qLast = q
+
+        if self.compress:
+            flags |= FLAG_COMPRESSED
+            data = zlib.compress(data, 1)
+        message = headerFrame.pack(FRAME, self.iFrame, time, encodings[self.encoding], flags) + data
+        self.iFrame += 1
+        return message
+
+    def quantize(self, v):
+        # return : [nv x 3] uint16 positions, whether they can be sent as a delta frame
+        v = np.asarray(v, dtype=np.float32)
+        lo, hi = v.min(0), v.max(0)
+        isDelta = self.delta and self.qLast is not None and self.iFrame % self.keyInterval != 0 and \
+            np.all(lo >= self.box[0]) and np.all(hi <= self.box[1])
+        if not isDelta:
+            margin = (hi - lo) * 0.1 + 1e-3     # room for the following delta frames
+            self.box = np.stack([lo - margin, hi + margin]).astype(np.float32)
+        scale = 65535 / (self.box[1] - self.box[0])
+        q = np.rint((v - self.box[0]) * scale).astype('<u2')
+        return q, isDelta
+
+
+class FrameDecoder(object):
+    # decodes the messages of FrameEncoder, the counterpart of the client side
+
+    def __init__(self):
+        self.e = None
+        self.nv = None
+        self.box = None
+        self.qLast = None
+
+    def decode(self, message):
+        # return : ('topology', e) or ('frame', (iFrame, time, v))
+        if message[0] == TOPOLOGY:
+            _, self.nv, ne, nBytes = headerTopology.unpack_from(message)
+            dtype = '<u2' if nBytes == 2 else '<u4'
+            self.e = np.frombuffer(message, dtype, ne * 2, headerTopology.size).reshape(ne, 2).astype(int)
+            return 'topology', self.e
+
+        _, iFrame, time, encoding, flags = headerFrame.unpack_from(message)
+        data = message[headerFrame.size:]
+        if flags & FLAG_COMPRESSED:
+            data = zlib.decompress(data)
+
+        if encoding == encodings['float32']:
+            v = np.frombuffer(data, '<f4').reshape(-1, 3).astype(np.float64)
+        elif encoding == encodings['float16']:
+            v = np.frombuffer(data, '<f2').reshape(-1, 3).astype(np.float64)
+        else:
+            if flags & FLAG_DELTA:
+                q = self.qLast + np.frombuffer(data, '<u2').reshape(-1, 3)
+            else:
+                self.box = np.array(headerBox.unpack_from(data), dtype=np.float32).reshape(2, 3)
+                q = np.frombuffer(data, '<u2', offset=headerBox.size).reshape(-1, 3)
+            self.qLast = q
+            v = (q.astype(np.float32) * ((self.box[1] - self.box[0]) / 65535) + self.box[0]).astype(np.float64)
+        return 'frame', (iFrame, time, v)
+
+
+def sendMessage(sock, message):
+    sock.sendall(headerLength.pack(len(message)) + message)
+
+
+def receiveMessage(sock):
+    # return : the next message, None when the connection is closed
+    header = receiveBytes(sock, headerLength.size)
+    if header is None:
+        return None
+    return receiveBytes(sock, headerLength.unpack(header)[0])
+
+
+def receiveBytes(sock, n):
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(n)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+class StreamServer(object):
+    # streams the positions of a model to any number of clients, over TCP or in process with connectLoopback
+    # publish only copies the positions into a buffer, each client has its own thread that encodes and sends the
+    # latest published positions, so a slow client skips frames instead of slowing the simulation down
+    # the server can also be attached as the recorder of the model to publish every stride steps:
+    # model.recorder = server
+
+    def __init__(self, model, host='127.0.0.1', port=0, stride=1, **encoderOptions):
+        # input: model: the streamed Model, its topology is sent once to each client
+        #        port: TCP port, 0: any free port, None: no TCP, only loopback clients
+        #        stride: number of steps between two published frames when attached as the recorder
+        #        encoderOptions: check FrameEncoder.__init__
+        self.e = np.copy(model.e)
+        self.nv = model.v.shape[-2]
+        self.stride = stride
+        self.encoderOptions = encoderOptions
+
+        self.v = np.copy(model.v)       # latest published positions
+        self.time = model.time
+        self.iPublished = 0
+        self.nStepsLast = None
+        self.condition = threading.Condition()
+        self.running = True
+        self.clients = []
+        self.nSent = 0
+        self.nSkipped = 0
+
+        self.sock = None
+        self.address = None
+        if port is not None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((host, port))
+            self.sock.listen()
+            self.address = self.sock.getsockname()
+            threading.Thread(target=self.acceptLoop, daemon=True).start()
+
+    def acceptLoop(self):
+        while self.running:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                return
+            self.addClient(sock)
+
+    def connectLoopback(self):
+        # return : a StreamClient connected through a socket pair, without networking
+        sockServer, sockClient = socket.socketpair()
+        self.addClient(sockServer)
+        return StreamClient(sockClient)
+
+    def addClient(self, sock):
+        thread = threading.Thread(target=self.clientLoop, args=(sock,), daemon=True)
+        self.clients.append(sock)
+        thread.start()
+
+    def clientLoop(self, sock):
+        encoder = FrameEncoder(**self.encoderOptions)
+        iSent = -1
+        try:
+            sendMessage(sock, FrameEncoder.encodeTopology(self.e, self.nv))
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: not self.running or self.iPublished > iSent)
+                    if not self.running:
+                        return
+                    if iSent >= 0:
+                        self.nSkipped += self.iPublished - iSent - 1
+                    iSent = self.iPublished
+                    v = np.copy(self.v)
+                    time = self.time
+                sendMessage(sock, encoder.encodeFrame(v, time))
+                self.nSent += 1
+        except OSError:
+            pass
+        finally:
+            sock.close()
+            self.clients.remove(sock)
+
+    def publish(self, model):
+        # make the current positions of the model the latest frame
+        with self.condition:
+            np.copyto(self.v, model.v)
+            self.time = model.time
+            self.iPublished += 1
+            self.condition.notify_all()
+
+    def record(self, model):
+        # called by Model.step when attached as the recorder of the model
+        if self.nStepsLast is not None and 0 <= model.nSteps - self.nStepsLast < self.stride:
+            return
+        self.nStepsLast = model.nSteps
+        self.publish(model)
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.sock is not None:
+            self.sock.close()
+
+
+class StreamClient(object):
+    # receives and decodes the stream of a StreamServer
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.e = None
+
+    @staticmethod
+    def connect(host, port):
+        return StreamClient(socket.create_connection((host, port)))
+
+    def receive(self):
+        # return : the next frame (iFrame, time, v), None when the stream is closed
+        while True:
+            message = receiveMessage(self.sock)
+            if message is None:
+                return None
+            kind, data = self.decoder.decode(message)
+            if kind == 'topology':
+                self.e = data
+            else:
+                return data
+
+    def close(self):
+        self.sock.close()
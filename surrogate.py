@@ -0,0 +1,126 @@
+import numpy as np
+
+
+class Surrogate(object):
+    # regression of the fitness on the genes, trained online on all the simulated (gene, fitness) pairs, to rank
+    # candidate genes before they are simulated, see EvolutionAlgorithm.setSurrogate
+    # kernel ridge regression, i.e. the mean of a gaussian process, on the genes normalized to the box, with a
+    # gaussian kernel; the offspring are close to their parents, so the width of the kernel is picked among fractions
+    # of the median distance between the training genes by the closed form leave-one-out error of the regression
+    # diverged genes (-inf) are trained at the min finite fitness, they are worse than all the others but do not
+    # distort the regression
+
+    widths = [0.05, 0.1, 0.2, 0.3, 0.5, 1.0]     # candidate widths of the kernel, relative to the median distance
+
+    def __init__(self, lb, ub, nTrainMax=1000, regularization=1e-2):
+        # input: lb, ub: bounds of the genes
+        #        nTrainMax: max number of training pairs, the best half and the most recent half of the archive, the
+        #                   fit costs O(nTrainMax ^ 3)
+        #        regularization: ridge added to the diagonal of the kernel matrix, relative to the fitness variance
+        self.lb = np.asarray(lb, dtype=np.float64)
+        self.scale = np.maximum(np.asarray(ub, dtype=np.float64) - self.lb, 1e-12)
+        self.nTrainMax = nTrainMax
+        self.regularization = regularization
+
+        # archive of the simulated genes
+        self.genes = np.zeros((0, len(self.lb)))    # [nArchive x len(lb)] normalized
+        self.fits = np.zeros(0)                     # [nArchive]
+        self.index = {}                             # bytes of a gene: its index in the archive
+
+        # model
+        self.x = None           # [nTrain x len(lb)] training genes
+        self.alpha = None       # [nTrain] weights of the training genes
+        self.width = None       # width of the gaussian kernel
+        self.fitMean = None
+        self.fitStd = None
+
+    def __len__(self):
+        return len(self.fits)
+
+    def normalize(self, pop):
+        return (np.asarray(pop, dtype=np.float64) - self.lb) / self.scale
+
+    def key(self, gene):
+        return np.ascontiguousarray(gene, dtype=np.float64).tobytes()
+
+    def add(self, pop, fits):
+        # add simulated genes to the archive, a gene already in it is not added again
+        isNew = np.zeros(len(pop), dtype=bool)
+        for i, gene in enumerate(pop):
+            key = self.key(gene)
+            if key not in self.index:
+                self.index[key] = len(self.fits) + np.count_nonzero(isNew)
+                isNew[i] = True
+        self.genes = np.append(self.genes, self.normalize(pop[isNew]), axis=0)
+        self.fits = np.append(self.fits, np.asarray(fits, dtype=np.float64)[isNew])
+
+    def lookup(self, pop):
+        # return : fitnesses of the genes found in the archive [n], nan for the others
+        fits = np.full(len(pop), np.nan)
+        for i, gene in enumerate(pop):
+            j = self.index.get(self.key(gene))
+            if j is not None:
+                fits[i] = self.fits[j]
+        return fits
+
+    @staticmethod
+    def distances2(x0, x1):
+        # return : squared distances [len(x0) x len(x1)]
+        d2 = np.sum(x0 ** 2, 1)[:, np.newaxis] + np.sum(x1 ** 2, 1)[np.newaxis, :] - 2 * x0 @ x1.T
+        return np.maximum(d2, 0)
+
+    def fit(self):
+        # train the regression on the archive
+        # return : whether there was enough data to train
+        fits = self.fits
+        isFinite = np.isfinite(fits)
+        if np.count_nonzero(isFinite) < 2:
+            self.alpha = None
+            return False
+        fits = np.where(isFinite, fits, np.min(fits[isFinite]))
+
+        iTrain = np.arange(len(fits))
+        if len(fits) > self.nTrainMax:
+            iBest = np.argsort(fits)[::-1][:self.nTrainMax // 2]
+            iRecent = np.setdiff1d(iTrain[len(fits) - self.nTrainMax:], iBest)[-(self.nTrainMax - len(iBest)):]
+            iTrain = np.union1d(iBest, iRecent)
+        self.x = self.genes[iTrain]
+        y = fits[iTrain]
+
+        self.fitMean = np.mean(y)
+        self.fitStd = np.std(y) + 1e-12
+        y = (y - self.fitMean) / self.fitStd
+        d2 = self.distances2(self.x, self.x)
+        distance = np.sqrt(np.median(d2[d2 > 0])) if np.any(d2 > 0) else 1.0
+
+        errorMin = np.inf
+        self.alpha = None
+        for width in self.widths:
+            K = np.exp(-d2 / (2 * (width * distance) ** 2))
+            K[np.diag_indices_from(K)] += self.regularization
+            KInv = np.linalg.inv(K)
+            alpha = KInv @ y
+            error = np.mean((alpha / np.diag(KInv)) ** 2)     # leave-one-out residuals of kernel ridge
+            error = error if np.isfinite(error) else np.inf
+            if error < errorMin or self.alpha is None:
+                errorMin = error
+                self.width = width * distance
+                self.alpha = alpha
+        return True
+
+    def predict(self, pop):
+        # return : predicted fitnesses of the genes [n]
+        K = np.exp(-self.distances2(self.normalize(pop), self.x) / (2 * self.width ** 2))
+        return self.fitMean + self.fitStd * (K @ self.alpha)
+
+    @staticmethod
+    def rankCorrelation(fits0, fits1):
+        # return : spearman correlation of the finite pairs, nan if fewer than 3
+        isFinite = np.isfinite(fits0) & np.isfinite(fits1)
+        if np.count_nonzero(isFinite) < 3:
+            return np.nan
+        ranks0 = np.argsort(np.argsort(fits0[isFinite]))
+        ranks1 = np.argsort(np.argsort(fits1[isFinite]))
+        if np.std(ranks0) == 0 or np.std(ranks1) == 0:
+            return np.nan
+        return np.corrcoef(ranks0, ranks1)[0, 1]
@@ -0,0 +1,227 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+import numpy as np
+rootPath = os.path.split(os.path.realpath(__file__))[0]
+
+
+class DistanceField(object):
+    # unsigned distance to the surface of a target mesh, sampled on a regular grid and read by trilinear interpolation
+    # the grid is computed once and saved next to the mesh as <name>.distance.npy with a json header,
+    # later loads memory-map the npy so that the worker processes share the same pages
+    # points outside the grid get the distance of the closest grid point plus the distance to the grid
+
+    version = 2
+
+    def __init__(self, grid, origin, spacing):
+        # input: grid: [nx x ny x nz] distances at origin + spacing * [i, j, k]
+        #        origin: [3] position of grid[0, 0, 0]
+        #        spacing: distance between two neighboring grid points
+        self.grid = grid
+        self.origin = np.array(origin, dtype=np.float64)
+        self.spacing = float(spacing)
+        self.shape = np.array(grid.shape)
+
+    @staticmethod
+    def build(mesh, spacing=0.05, padding=1.0, nBlock=4):
+        # the exact distances to the triangles of the mesh, no sampling of the surface, so the build is reproducible
+        # and leaves the random state untouched; the grid is split into blocks of nBlock ^ 3 points, the distances of
+        # the centers of the blocks to all the triangles bound which triangles can be the closest to each block
+        # input: mesh: trimesh.Trimesh of the target
+        #        padding: margin of the grid around the bounds of the mesh
+        #        nBlock: number of grid points along the edges of the blocks
+        from trimesh.triangles import closest_point
+        lo = mesh.bounds[0] - padding
+        hi = mesh.bounds[1] + padding
+        shape = np.ceil((hi - lo) / spacing).astype(int) + 1
+        index = np.stack(np.meshgrid(*[np.arange(n) for n in shape], indexing='ij'), -1).reshape(-1, 3)
+        points = lo + spacing * index
+
+        def distances(triangle, points):
+            return np.linalg.norm(closest_point(np.repeat(triangle[np.newaxis], len(points), 0), points) - points, axis=1)
+
+        shapeBlock = -(-shape // nBlock)
+        centers = np.stack(np.meshgrid(*[np.arange(n) for n in shapeBlock], indexing='ij'), -1).reshape(-1, 3)
+        centers = lo + spacing * (nBlock * centers + (nBlock - 1) / 2)
+        radius = spacing * (nBlock - 1) * np.sqrt(3) / 2     # max distance of the points of a block to its center
+        dCenters = np.stack([distances(triangle, centers) for triangle in mesh.triangles], 1)
+
+        # the points of a block are within radius of the center, a triangle farther than the closest one + 2 radius
+        # from the center cannot be the closest to any of them
+        isCandidate = dCenters <= dCenters.min(1, keepdims=True) + 2 * radius
+        iBlock = np.ravel_multi_index((index // nBlock).T, shapeBlock)
+        d = np.full(len(points), np.inf)
+        for i, triangle in enumerate(mesh.triangles):
+            iPoints = np.nonzero(isCandidate[iBlock, i])[0]
+            for iChunk in np.array_split(iPoints, max(1, len(iPoints) // 2 ** 18)):
+                d[iChunk] = np.minimum(d[iChunk], distances(triangle, points[iChunk]))
+        return DistanceField(d.reshape(shape), lo, spacing)
+
+    @staticmethod
+    def load(targetName, spacing=0.05, padding=1.0):
+        # load the field of data/target/<targetName>.obj, built and saved first if missing or out of date
+        name = os.path.join(rootPath, 'data/target/', targetName)
+        with open(name + '.obj', 'rb') as f:
+            meshHash = hashlib.sha1(f.read()).hexdigest()
+        header = {'version': DistanceField.version, 'meshHash': meshHash, 'spacing': spacing, 'padding': padding}
+
+        try:
+            with open(name + '.distance.json') as f:
+                headerSaved = json.load(f)
+            if all(headerSaved.get(k) == x for k, x in header.items()):
+                grid = np.load(name + '.distance.npy', mmap_mode='r')
+                return DistanceField(grid, headerSaved['origin'], spacing)
+        except (IOError, ValueError):
+            pass
+
+        import trimesh
+        field = DistanceField.build(trimesh.load(name + '.obj'), spacing, padding)
+        header['origin'] = field.origin.tolist()
+        header['shape'] = field.shape.tolist()
+        field.save(name, header)
+        field.grid = np.load(name + '.distance.npy', mmap_mode='r')
+        return field
+
+    def save(self, name, header):
+        # write to temporary files first, so that concurrent loads never see a partial field
+        tmp = '.{}.tmp'.format(os.getpid())
+        with open(name + '.distance.npy' + tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.grid), allow_pickle=False)
+        with open(name + '.distance.json' + tmp, 'w') as f:
+            json.dump(header, f)
+        os.replace(name + '.distance.npy' + tmp, name + '.distance.npy')
+        os.replace(name + '.distance.json' + tmp, name + '.distance.json')
+
+    def __call__(self, points):
+        # input: points: [... x 3]
+        # return : distances [...], in the dtype of the points, e.g. float32 for a float32 model
+        points = np.asarray(points)
+        dtype = points.dtype if points.dtype in [np.float32, np.float64] else np.dtype(np.float64)
+        p = (points - self.origin.astype(dtype)) / self.spacing
+        upper = (self.shape - 1).astype(dtype)
+        pClamped = np.clip(p, 0, upper)
+        outside = np.sqrt(np.sum((p - pClamped) ** 2, -1)) * self.spacing
+
+        i0 = np.minimum(np.floor(pClamped), upper - 1)
+        t = pClamped - i0
+        i0 = i0.astype(np.int64)
+        ix, iy, iz = i0[..., 0], i0[..., 1], i0[..., 2]
+        tx, ty, tz = t[..., 0], t[..., 1], t[..., 2]
+
+        d = np.zeros(p.shape[:-1], dtype)
+        for dx, wx in ((0, 1 - tx), (1, tx)):
+            for dy, wy in ((0, 1 - ty), (1, ty)):
+                for dz, wz in ((0, 1 - tz), (1, tz)):
+                    d += wx * wy * wz * self.grid[ix + dx, iy + dy, iz + dz].astype(dtype, copy=False)
+        return d + outside
+
+
+class ParametricTarget(object):
+    # a target shape given by a vectorized map of the rest positions of the vertices of a model
+    # the centers default to the center of the bounding box of the rest positions, the heights are measured from
+    # the bottom of the model and d is the height of the bottom at the center of the target
+    # the mapped positions are cached per model geometry and target parameters, see getPositions; the cache is an
+    # LRU dict shared by the criteria of the process, bounded so that sweeps over the parameters do not grow it
+
+    name = None
+    defaultParams = {}
+    cache = OrderedDict()   # (model hash, model dtype, target hash): [nv x 3] read-only positions
+    cacheSize = 8           # max number of positions kept
+
+    def __init__(self, **params):
+        unknown = set(params) - set(self.defaultParams)
+        if unknown:
+            raise ValueError('Unknown parameters of the target {}: {}'.format(self.name, sorted(unknown)))
+        self.params = dict(self.defaultParams, **params)
+
+    def __call__(self, v):
+        # input: v: [nv x 3] rest positions
+        # return : [nv x 3] target positions
+        v = np.asarray(v, dtype=np.float64)
+        lo, hi = v.min(0), v.max(0)
+        center = (lo + hi) / 2 if self.params.get('center') is None else np.array(self.params['center'], float)
+        return self.map(v[:, 0] - center[0], v[:, 1] - center[1], v[:, 2] - lo[2], center)
+
+    def map(self, x, y, z, center):
+        # input: x, y: [nv] coordinates relative to the center, z: [nv] heights above the bottom
+        raise NotImplementedError('Please define the map of the target.')
+
+    def getHash(self):
+        config = json.dumps(self.getConfig(), sort_keys=True)
+        return hashlib.sha1(config.encode()).hexdigest()
+
+    def getConfig(self):
+        return {'name': self.name, 'params': self.params}
+
+    @staticmethod
+    def fromConfig(config):
+        return targetDict[config['name']](**config['params'])
+
+    def getPositions(self, model):
+        # return : [nv x 3] target positions of the vertices of the model at rest, the model is not reset
+        #          mapped in float64 and stored in the dtype of the model
+        cache = ParametricTarget.cache
+        key = (model.getHash(), model.dtype.str, self.getHash())
+        if key not in cache:
+            positions = self(model.snapshot['v']).astype(model.dtype)
+            positions.setflags(write=False)
+            cache[key] = positions
+            while len(cache) > ParametricTarget.cacheSize:
+                cache.popitem(last=False)
+        cache.move_to_end(key)
+        return cache[key]
+
+
+class TargetCylinder(ParametricTarget):
+    # bend around a cylinder of radius R along y, the layers above the bottom are moved toward the axis
+    name = 'cylinder'
+    defaultParams = {'R': 3.0, 'd': -0.6, 'center': None}
+
+    def map(self, x, y, z, center):
+        R, d = self.params['R'], self.params['d']
+        alpha = x / R
+        r = R - z
+        return np.stack([center[0] + r * np.sin(alpha), center[1] + y, R + d - r * np.cos(alpha)], 1)
+
+
+class TargetSphereCap(ParametricTarget):
+    # wrap on a sphere of radius R, the distances to the center are kept along the great circles
+    name = 'sphereCap'
+    defaultParams = {'R': 3.0, 'd': -0.6, 'center': None}
+
+    def map(self, x, y, z, center):
+        R, d = self.params['R'], self.params['d']
+        rPlane = np.sqrt(x ** 2 + y ** 2)
+        theta = rPlane / R
+        r = R - z
+        ratio = np.divide(r * np.sin(theta), rPlane, out=np.zeros_like(rPlane), where=rPlane > 0)
+        return np.stack([center[0] + ratio * x, center[1] + ratio * y, R + d - r * np.cos(theta)], 1)
+
+
+class TargetSaddle(ParametricTarget):
+    # lift to the hyperbolic paraboloid of curvature 1 / R along x and -1 / R along y
+    name = 'saddle'
+    defaultParams = {'R': 3.0, 'd': 0.0, 'center': None}
+
+    def map(self, x, y, z, center):
+        R, d = self.params['R'], self.params['d']
+        return np.stack([center[0] + x, center[1] + y, d + z + (x ** 2 - y ** 2) / (2 * R)], 1)
+
+
+class TargetTwist(ParametricTarget):
+    # twist around the x axis through the center, by rate radians per unit length along x
+    name = 'twist'
+    defaultParams = {'rate': 0.1, 'd': 0.0, 'center': None}
+
+    def map(self, x, y, z, center):
+        rate, d = self.params['rate'], self.params['d']
+        angle = rate * x
+        height = (np.max(z) + np.min(z)) / 2      # the axis is at mid height
+        zc = z - height
+        return np.stack([center[0] + x,
+                         center[1] + y * np.cos(angle) - zc * np.sin(angle),
+                         d + height + y * np.sin(angle) + zc * np.cos(angle)], 1)
+
+
+targetDict = {target.name: target for target in [TargetCylinder, TargetSphereCap, TargetSaddle, TargetTwist]}
@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing
+import numpy as np
+rootPath = os.path.abspath(os.path.join(os.path.realpath(__file__), '../..'))
+sys.path.append(rootPath)
+
+from model import Model, getModelNames
+from env import Env
+from kernel import numba
+import generator
+
+# headless benchmarks of the simulation and the optimization, the results are written to a json file
+# usage: python utils/benchmark.py run -o benchmark.json [--quick]
+#        python utils/benchmark.py compare baseline.json benchmark.json [--threshold 0.1]
+#        compare exits with 1 if a result regressed by more than threshold relative to the baseline
+
+latticeSizes = [16, 32]     # generated n x n x 1 lattices, in addition to the models under data/model
+h = 0.0005                  # small enough for all the models to stay stable
+tasks = [
+    # criterionName, modelName, agentName, policyName
+    ('moveForward', 'tet', 'binary', 'tetrahedronMoveForward'),
+    ('shape', 'column', 'actuate', 'approximateSnakeShape'),
+    ('curvedSheet', '8x8x1', 'actuate', 'approximateCurvedSheet'),
+]
+
+
+def measure(f, duration):
+    # return : number of calls of f per second, f is called until duration seconds have passed
+    f()     # warm up, e.g. numba compilation
+    n = 0
+    t0 = time.time()
+    while True:
+        f()
+        n += 1
+        t = time.time() - t0
+        if t >= duration:
+            return n / t
+
+
+def benchmarkStep(results, duration):
+    geometries = {name: (None, None) for name in getModelNames()}
+    for n in latticeSizes:
+        geometries['benchmarkLattice{}'.format(n)] = generator.sheet(n, n)
+    backends = ['numpy', 'inPlace'] + (['numba'] if numba is not None else [])
+    for modelName, (v, e) in geometries.items():
+        for backend in backends:
+            model = Model(modelName, backend, v, e)
+            model.h = h
+            model.setShrinkage(0.2)
+            nSteps = 10
+            rate = measure(lambda: model.step(nSteps), duration) * nSteps
+            record(results, 'step/{}/{}'.format(modelName, backend), rate, 'steps/s', True)
+
+
+def benchmarkRollout(results, duration):
+    for criterionName, modelName, agentName, policyName in tasks:
+        env = Env(modelName, agentName, criterionName, timeStep=h)
+        policy = np.load(os.path.join(rootPath, 'data/agent/', policyName + '.npy'))
+        rate = measure(lambda: env.criterion(policy), duration)
+        record(results, 'rollout/{}/{}'.format(criterionName, modelName), 1000 / rate, 'ms', False)
+
+
+def benchmarkEvaluate(results, duration, nPop):
+    nCpus = multiprocessing.cpu_count()
+    env = Env('tet', 'binary', 'moveForward', timeStep=h)
+    optimizer = env.optimizer
+    optimizer.nPop = nPop
+    optimizer.reset()
+
+    optimizer.batch = True
+    rate = measure(optimizer.evaluate, duration) * nPop
+    record(results, 'evaluate/batch', rate, 'evaluations/s', True)
+
+    optimizer.batch = False
+    for nWorkers in sorted({1, 2, nCpus}):
+        optimizer.nWorkers = nWorkers
+        optimizer.openEvaluator(nPop)
+        try:
+            rate = measure(optimizer.evaluate, duration) * nPop
+        finally:
+            optimizer.closeEvaluator()
+        record(results, 'evaluate/workers{}'.format(nWorkers), rate, 'evaluations/s', True)
+
+
+def record(results, name, value, unit, higherIsBetter):
+    results[name] = {'value': value, 'unit': unit, 'higherIsBetter': higherIsBetter}
+    print('{:40s} {:12.3f} {}'.format(name, value, unit))
+
+
+def getMetadata():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=rootPath,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'numba': numba.__version__ if numba is not None else None,
+        'machine': platform.machine(),
+        'nCpus': multiprocessing.cpu_count(),
+    }
+
+
+def run(path, quick=False):
+    duration = 0.2 if quick else 1.0
+    results = {}
+    benchmarkStep(results, duration)
+    benchmarkRollout(results, duration)
+    benchmarkEvaluate(results, duration, nPop=8 if quick else 40)
+
+    # peak resident memory, in kilobytes on linux
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    memoryChildren = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    record(results, 'memory/peak', memory / 1024, 'MB', False)
+    record(results, 'memory/peakWorker', memoryChildren / 1024, 'MB', False)
+
+    with open(path, 'w') as f:
+        json.dump({'metadata': getMetadata(), 'results': results}, f, indent=2)
+
+
+def compare(pathBaseline, path, threshold=0.1):
+    # return : whether no result regressed by more than threshold
+    with open(pathBaseline) as f:
+        baseline = json.load(f)['results']
+    with open(path) as f:
+        results = json.load(f)['results']
+
+    passed = True
+    for name in sorted(set(baseline) | set(results)):
+        if name not in baseline or name not in results:
+            print('{:40s} {}'.format(name, 'only in baseline' if name in baseline else 'new'))
+            continue
+        x0, x1 = baseline[name]['value'], results[name]['value']
+        ratio = x1 / x0 if x0 else np.inf
+        if not results[name]['higherIsBetter']:
+            ratio = 1 / ratio if ratio else np.inf
+        regressed = ratio < 1 - threshold
+        passed = passed and not regressed
+        print('{:40s} {:12.3f} -> {:12.3f} {:14s} x{:6.2f}  {}'.format(
+            name, x0, x1, results[name]['unit'], ratio, 'REGRESSED' if regressed else ''))
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    parserRun = subparsers.add_parser('run', help='run the benchmarks')
+    parserRun.add_argument('-o', '--output', default='benchmark.json', help='json file of the results')
+    parserRun.add_argument('--quick', action='store_true', help='shorter measurements, for a smoke test')
+    parserCompare = subparsers.add_parser('compare', help='compare results with a baseline')
+    parserCompare.add_argument('baseline')
+    parserCompare.add_argument('results')
+    parserCompare.add_argument('--threshold', type=float, default=0.1,
+                               help='relative slowdown flagged as a regression')
+    args = parser.parse_args()
+
+    np.seterr(all='ignore')
+    if args.command == 'run':
+        run(args.output, args.quick)
+    elif args.command == 'compare':
+        return compare(args.baseline, args.results, args.threshold)
+    else:
+        parser.print_help()
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import numpy as np
+rootPath = os.path.abspath(os.path.join(os.path.realpath(__file__), '../..'))
+sys.path.append(rootPath)
+
+from model import Model, getModelNames
+
+# check that all the stepping backends of Model give the same results on every model under data/model
+# usage: python utils/checkBackends.py
+
+backends = ['numpy', 'inPlace', 'numba']
+nSteps = 200        # steps between two changes of the shrinkage
+h = 0.0005
+tolerance = 1e-8    # max deviation of the positions from the 'numpy' backend
+
+
+def simulate(modelName, backend, ground):
+    model = Model(modelName, backend)
+    model.h = h
+    model.ground = ground
+    t = time.time()
+    for s in [0.3, 0.1, 0.2]:
+        model.setShrinkage(s)
+        model.step(nSteps)
+    t = time.time() - t
+    return model, t
+
+
+def main():
+    modelNames = getModelNames()
+    passed = True
+    for modelName in modelNames:
+        for ground in [0, 1, 2]:
+            reference, tReference = simulate(modelName, 'numpy', ground)
+            for backend in backends[1:]:
+                model, t = simulate(modelName, backend, ground)
+                error = np.max(np.abs(model.v - reference.v))
+                ok = error <= tolerance and np.allclose(model.vel, reference.vel, rtol=1e-6, atol=tolerance)
+                passed = passed and ok
+                print('{:8s} ground {} {:8s} max error {:.3e}  speedup {:6.2f}  {}'.format(
+                    modelName, ground, model.backend, error, tReference / t, 'ok' if ok else 'FAILED'))
+    return passed
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
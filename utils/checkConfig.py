@@ -0,0 +1,53 @@
+import os
+import sys
+rootPath = os.path.abspath(os.path.join(os.path.realpath(__file__), '../..'))
+sys.path.append(rootPath)
+
+from env import Env
+from cache import FitnessCache
+from criterion import RolloutMonitor
+
+# check that the settings of the rollouts survive Env.fromConfig, as used by the worker processes of the evaluator,
+# and that they change the key of the fitness cache
+# usage: python utils/checkConfig.py
+
+settings = {
+    # label: function changing the criterion of an env
+    'default': lambda criterion: None,
+    'monitor': lambda criterion: setattr(criterion, 'monitor',
+                                         RolloutMonitor(nInterval=5, vMax=50, velTolerance=1e-2, energyMax=1e4)),
+    'no monitor': lambda criterion: setattr(criterion, 'monitor', None),
+    'steady': lambda criterion: setattr(criterion, 'steady', True),
+    'worstScore': lambda criterion: setattr(criterion, 'worstScore', -1e6),
+}
+
+
+def getContext(env):
+    cache = FitnessCache()
+    cache.setContext(env)
+    return cache.context
+
+
+def main():
+    passed = True
+    contexts = {}
+    for label, change in settings.items():
+        env = Env('tet')
+        change(env.criterion)
+        config = env.criterion.getConfig()
+        envCopy = Env.fromConfig(env.getConfig())
+        ok = envCopy.criterion.getConfig() == config and getContext(envCopy) == getContext(env)
+        if config['monitor'] is not None:
+            ok = ok and envCopy.criterion.monitor is not env.criterion.monitor
+        contexts[label] = getContext(env)
+        passed = passed and ok
+        print('{:12s} round trip {}'.format(label, 'ok' if ok else 'FAILED'))
+
+    ok = len(set(contexts.values())) == len(contexts)
+    passed = passed and ok
+    print('cache keys distinct {}'.format('ok' if ok else 'FAILED'))
+    return passed
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
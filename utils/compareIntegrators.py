@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import numpy as np
+rootPath = os.path.abspath(os.path.join(os.path.realpath(__file__), '../..'))
+sys.path.append(rootPath)
+
+from model import Model
+
+# check that the implicit integrator gives the final shapes of the explicit reference, up to factorMax times its step
+# the tasks replay the trained policies of the examples under data/agent for the same simulated time
+# the deviations are the max over the vertices, relative to the size of the reference shape
+# the explicit kernels are printed at the same step sizes, for scale: they diverge beyond 2x, and at 2x their own
+# deviation from the reference is 3% - 10%; the step sizes beyond factorMax are printed but not supported
+# usage: python utils/compareIntegrators.py
+
+tasks = [
+    # modelName, policyName, explicit step size, nSteps, gravity
+    ('8x8x1', 'approximateCurvedSheet', 0.001, 1000, 0),
+    ('column', 'approximateSnakeShape', 0.002, 1000, 9.8 * 2),
+]
+factors = [1, 2, 5, 10, 20, 50]     # step size of the implicit integrator relative to the explicit one
+factorMax = 20          # largest factor supported by the implicit integrator, see KernelImplicit
+tolerance = 2e-3        # max relative deviation at the step size of the reference
+toleranceShape = 5e-2   # max relative deviation at the larger step sizes up to factorMax
+
+
+def simulate(modelName, policy, h, nSteps, g, integrator, factor):
+    model = Model(modelName)
+    model.rough()
+    model.g = g
+    model.h = h
+    model.setShrinkage(policy)
+    model.setIntegrator(integrator, h * factor)
+    t = time.time()
+    model.step(int(round(nSteps / factor)))
+    return model, time.time() - t
+
+
+def main():
+    np.seterr(all='ignore')     # the explicit runs at large step sizes overflow on purpose
+    passed = True
+    for modelName, policyName, h, nSteps, g in tasks:
+        policy = np.load(os.path.join(rootPath, 'data/agent/', policyName + '.npy'))
+        reference, tReference = simulate(modelName, policy, h, nSteps, g, 'explicit', 1)
+        size = np.linalg.norm(reference.v.max(0) - reference.v.min(0))
+        print('{} ({}), explicit h = {}, {} steps, {:.3f} s, size {:.2f}'.format(
+            modelName, policyName, h, nSteps, tReference, size))
+
+        for integrator in ['explicit', 'implicit']:
+            for factor in factors:
+                if integrator == 'explicit' and factor == 1:
+                    continue
+                if integrator == 'explicit':
+                    status = ''
+                elif factor > factorMax:
+                    status = 'unsupported'
+                else:
+                    status = None   # checked below
+
+                model, t = simulate(modelName, policy, h, nSteps, g, integrator, factor)
+                if not np.isfinite(model.v).all() or np.abs(model.v).max() > 1e3:
+                    status = 'FAILED' if status is None else status
+                    passed = passed and status != 'FAILED'
+                    print('  {:8s} h x {:3d}: diverged  {}'.format(integrator, factor, status).rstrip())
+                    continue
+                deviation = np.sqrt(np.sum((model.v - reference.v) ** 2, 1)) / size
+                if status is None:
+                    ok = deviation.max() <= (tolerance if factor == 1 else toleranceShape)
+                    passed = passed and ok
+                    status = 'ok' if ok else 'FAILED'
+                print('  {:8s} h x {:3d}: relative vertex deviation max {:.4f} mean {:.4f}, {:.3f} s  {}'.format(
+                    integrator, factor, deviation.max(), deviation.mean(), t, status).rstrip())
+    return passed
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
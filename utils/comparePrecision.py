@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import numpy as np
+rootPath = os.path.abspath(os.path.join(os.path.realpath(__file__), '../..'))
+sys.path.append(rootPath)
+
+from env import Env
+from kernel import numba
+
+# compare the float32 precision with the float64 reference on the examples, replaying their trained policies
+# reports the deviation of the final shapes and of the scores, and checks that the float32 state is not upcast
+# usage: python utils/comparePrecision.py
+#        exits with 1 if a deviation exceeds its tolerance
+
+tasks = [
+    # policyName, modelName, agentName, criterionName, timeStep, settings of the model
+    ('tetrahedronMoveForward', 'tet', 'binary', 'moveForward', None, {}),
+    ('approximateSnakeShape', 'column', 'actuate', 'shape', 0.002, {}),
+    ('approximateCurvedSheet', '8x8x1', 'actuate', 'curvedSheet', 0.001, {'g': 0}),
+    ('approximateCurvedSheetLarge', '8x8x1', 'actuate', 'curvedSheet', 0.0005, {'g': 0, 'sMax': 0.5}),
+]
+backends = ['numpy', 'inPlace'] + (['numba'] if numba is not None else [])
+toleranceShape = 1e-3   # max vertex deviation relative to the size of the model
+toleranceScore = 1e-3   # deviation of the score relative to its magnitude, or absolute below 1
+
+
+def evaluate(policyName, modelName, agentName, criterionName, timeStep, settings, backend, precision):
+    env = Env(modelName, agentName, criterionName, timeStep, backend, precision=precision)
+    for k, x in settings.items():
+        setattr(env.model, k, x)
+    env.model.reset()
+    policy = np.load(os.path.join(rootPath, 'data/agent/', policyName + '.npy'))
+    env.criterion.monitor = None    # the same number of steps in both precisions
+
+    t = time.time()
+    score = env.criterion(policy)
+    t = time.time() - t
+
+    upcast = sorted(k for k in env.model.stateArrays
+                    if getattr(env.model, k).dtype.kind == 'f' and getattr(env.model, k).dtype != env.model.dtype)
+    return env.model.v, score, t, upcast
+
+
+def main():
+    np.seterr(all='ignore')
+    passed = True
+    for task in tasks:
+        print('{} ({}, {})'.format(task[0], task[1], task[3]))
+        for backend in backends:
+            v64, score64, t64, _ = evaluate(*task, backend, 'float64')
+            v32, score32, t32, upcast = evaluate(*task, backend, 'float32')
+
+            size = np.max(np.ptp(v64, 0))
+            deviation = np.sqrt(np.sum((v32.astype(np.float64) - v64) ** 2, 1))
+            deviationScore = abs(float(score32) - score64) / max(abs(score64), 1)
+            ok = deviation.max() / size <= toleranceShape and deviationScore <= toleranceScore and not upcast
+            passed = passed and ok
+            print('  {:8s} vertex deviation max {:.2e} mean {:.2e}, score {:.6f} -> {:.6f} ({:.1e}), '
+                  '{:.3f} s -> {:.3f} s {}{}'.format(
+                      backend, deviation.max(), deviation.mean(), score64, float(score32), deviationScore, t64, t32,
+                      '' if ok else 'FAILED', ', upcast: ' + ', '.join(upcast) if upcast else ''))
+    return passed
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
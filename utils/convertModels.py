@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+rootPath = os.path.abspath(os.path.join(os.path.realpath(__file__), '../..'))
+sys.path.append(rootPath)
+
+from model import modelPath, saveBinary, loadBinary, hashGeometry
+
+# convert the json models under data/model to the binary format read by Model, see model.saveBinary
+# usage: python utils/convertModels.py [names ...]
+#        without names, all the json models are converted, the json files are kept
+
+
+def convert(name):
+    t = time.time()
+    with open(os.path.join(modelPath, name + '.json')) as f:
+        data = json.load(f)
+    v = np.array(data['v'], dtype=np.float64)
+    e = np.array(data['e'])
+    tJson = time.time() - t
+
+    header = saveBinary(name, v, e)
+    t = time.time()
+    vBinary, eBinary, _ = loadBinary(name)
+    tBinary = time.time() - t
+    assert(hashGeometry(vBinary, eBinary) == header['hash'] == hashGeometry(v, e))
+
+    sizeJson = os.path.getsize(os.path.join(modelPath, name + '.json'))
+    sizeBinary = sum(os.path.getsize(os.path.join(modelPath, name + suffix))
+                     for suffix in ['.v.npy', '.e.npy', '.model.json'])
+    print('{:20s} nv {:8d} ne {:8d} edges {:6s} {:10d} B -> {:10d} B  load {:8.2f} ms -> {:6.2f} ms'.format(
+        name, header['nv'], header['ne'], np.dtype(header['eDtype']).name, sizeJson, sizeBinary,
+        tJson * 1000, tBinary * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', help='names of the models under data/model, all by default')
+    args = parser.parse_args()
+
+    names = args.names or sorted(fileName[:-len('.json')] for fileName in os.listdir(modelPath)
+                                 if fileName.endswith('.json') and not fileName.endswith('.model.json'))
+    for name in names:
+        convert(name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+import traceback
+import multiprocessing
+import numpy as np
+from model import BatchedModel
+
+# vector envs stepping nEnvs copies of an env together, e.g. to feed a reinforcement learner
+# the action of a copy is its shrinkage [ne], clipped to the action space, each step of the vector env runs
+# nSubsteps steps of the model
+# the reward of a step is the change of the score of the criterion of the env, see Criterion.getScores, so the
+# rewards of an episode sum up to its score; an episode ends after the steps of a rollout of the criterion or when
+# the copy diverges, and the copy is then reset automatically: the observation returned is the first one of the
+# next episode and the last one of the episode is in observationsFinal
+# the actions, observations, rewards and dones are preallocated buffers, the arrays returned by step are views of
+# them, valid until the next step
+
+bufferSpecs = [
+    # name, whether the buffer is bool instead of the dtype of the model, whether it has one row per copy
+    ('actions', False, True),
+    ('observations', False, True),
+    ('observationsFinal', False, True),
+    ('rewards', False, False),
+    ('dones', True, False),
+]
+
+
+def allocateBuffers(nEnvs, nActions, nObservations, dtype=np.float64, shared=False):
+    # return : {name: buffer}, multiprocessing.RawArray if shared, so that worker processes can map them
+    sizes = {'actions': nActions, 'observations': nObservations, 'observationsFinal': nObservations}
+    buffers = {}
+    for name, isBool, perCopy in bufferSpecs:
+        n = nEnvs * sizes[name] if perCopy else nEnvs
+        dtypeBuffer = np.dtype(bool if isBool else dtype)
+        buffers[name] = multiprocessing.RawArray('b' if isBool else dtypeBuffer.char, n) if shared else \
+            np.zeros(n, dtype=dtypeBuffer)
+    return buffers
+
+
+def viewBuffers(buffers, nEnvs, dtype=np.float64, start=0, stop=None):
+    # return : {name: numpy view of the rows [start, stop) of the buffer}
+    stop = nEnvs if stop is None else stop
+    views = {}
+    for name, isBool, perCopy in bufferSpecs:
+        x = np.frombuffer(buffers[name], dtype=bool if isBool else dtype)
+        x = x.reshape(nEnvs, -1) if perCopy else x
+        views[name] = x[start:stop]
+    return views
+
+
+class VectorEnv(object):
+    # superclass of the vector envs
+
+    def __init__(self, env, nEnvs, nSubsteps=1):
+        self.nEnvs = nEnvs
+        self.nSubsteps = nSubsteps
+        self.actionSpace = env.model.actionSpace            # of a single copy
+        self.observationSpace = env.model.observationSpace
+
+        self.actions = None             # [nEnvs x ne]
+        self.observations = None        # [nEnvs x nObservation]
+        self.observationsFinal = None   # [nEnvs x nObservation] last observation of the episodes that just ended
+        self.rewards = None             # [nEnvs]
+        self.dones = None               # [nEnvs] bool
+
+    def setBuffers(self, views):
+        for name, x in views.items():
+            setattr(self, name, x)
+
+    def reset(self):
+        # reset all the copies
+        # return : observations [nEnvs x nObservation]
+        self.resetAsync()
+        return self.resetWait()
+
+    def step(self, actions):
+        # input: actions: [nEnvs x ne]
+        # return : observations [nEnvs x nObservation], rewards [nEnvs], dones [nEnvs]
+        self.stepAsync(actions)
+        return self.stepWait()
+
+    def stepAsync(self, actions):
+        # start a step, the actions are copied, the results are collected by stepWait
+        if actions is not None:
+            np.copyto(self.actions, actions)
+
+    def stepWait(self):
+        raise NotImplementedError('Please implement stepWait function.')
+
+    def resetAsync(self):
+        raise NotImplementedError('Please implement resetAsync function.')
+
+    def resetWait(self):
+        raise NotImplementedError('Please implement resetWait function.')
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BatchedVectorEnv(VectorEnv):
+    # the copies are simulated in process by one BatchedModel, the step is done by stepWait
+
+    def __init__(self, env, nEnvs, nSubsteps=1, views=None):
+        # input: env: the env copied, its model is reset and its criterion gives the rewards and the episode length
+        #        views: buffers the copies read and write, see viewBuffers, allocated if None
+        super().__init__(env, nEnvs, nSubsteps)
+        self.env = env
+        self.criterion = env.criterion
+        env.reset()
+        self.model = BatchedModel(env.model, nEnvs)
+
+        criterion = self.criterion
+        nSteps = criterion.nSteps if criterion.duration is None else int(np.ceil(criterion.duration / env.model.h))
+        self.nStepsEpisode = int(np.ceil(nSteps / nSubsteps))  # steps of the vector env per episode
+        self.vMax = criterion.monitor.vMax if criterion.monitor is not None else np.inf
+        self.rewardDiverged = -1.0      # reward of the step a copy diverges at
+
+        if views is None:
+            dtype = env.model.dtype
+            views = viewBuffers(allocateBuffers(nEnvs, self.actionSpace.shape[0], self.observationSpace.shape[0],
+                                                dtype), nEnvs, dtype)
+        self.setBuffers(views)
+
+        self.iSteps = np.zeros(nEnvs, dtype=int)    # steps of the current episode of each copy
+        self.scoresInit = None                      # scores of the copies after reset
+        self.scores = None                          # scores at the last step
+        self.resetWait()
+
+    def resetAsync(self):
+        pass
+
+    def resetWait(self):
+        self.model.reset()
+        self.iSteps[:] = 0
+        with np.errstate(invalid='ignore', over='ignore'):
+            self.scoresInit = self.criterion.getScores(self.model)
+        self.scores = np.copy(self.scoresInit)
+        self.rewards[:] = 0
+        self.dones[:] = False
+        return self.model.getObservation(out=self.observations)
+
+    def stepWait(self):
+        model = self.model
+        np.clip(self.actions, self.actionSpace.low, self.actionSpace.high, out=self.actions)
+        model.setShrinkage(self.actions)
+        model.step(self.nSubsteps)
+        self.iSteps += 1
+
+        with np.errstate(invalid='ignore', over='ignore'):
+            scores = self.criterion.getScores(model)
+            diverged = np.invert(np.isfinite(model.v).all((1, 2)) & np.isfinite(model.vel).all((1, 2))) | \
+                (np.abs(model.v).max((1, 2)) > self.vMax)
+        np.subtract(scores, self.scores, out=self.rewards)
+        self.rewards[diverged] = self.rewardDiverged
+        self.scores = scores
+        np.logical_or(diverged, self.iSteps >= self.nStepsEpisode, out=self.dones)
+
+        model.getObservation(out=self.observations)
+        if self.dones.any():
+            dones = self.dones
+            self.observationsFinal[dones] = self.observations[dones]
+            model.resetCopies(dones)
+            self.iSteps[dones] = 0
+            self.scores[dones] = self.scoresInit[dones]
+            model.getObservation(out=self.observations)
+        return self.observations, self.rewards, self.dones
+
+
+def runWorker(pipe, config, buffers, nEnvs, start, stop, nSubsteps):
+    # steps the copies [start, stop) of a SubprocessVectorEnv in the shared buffers, on the commands of the pipe
+    try:
+        from env import Env     # imported here, env imports this module
+        vector = BatchedVectorEnv(Env.fromConfig(config), stop - start, nSubsteps,
+                                  viewBuffers(buffers, nEnvs, config['model']['precision'], start, stop))
+        pipe.send(None)
+        while True:
+            command = pipe.recv()
+            if command == 'step':
+                vector.stepWait()
+            elif command == 'reset':
+                vector.resetWait()
+            elif command == 'close':
+                return
+            pipe.send(None)
+    except (KeyboardInterrupt, EOFError):
+        pass
+    except Exception:
+        pipe.send(traceback.format_exc())
+
+
+class SubprocessVectorEnv(VectorEnv):
+    # the copies are split among worker processes, each stepping a BatchedVectorEnv on its rows of the buffers
+    # the buffers are shared memory, so only the commands are sent to the workers, stepAsync returns at once and
+    # the main process can work until stepWait
+
+    def __init__(self, env, nEnvs, nWorkers=None, nSubsteps=1):
+        # input: env: the env copied, each worker builds its own from Env.getConfig()
+        #        nWorkers: number of worker processes, the number of cpus by default, at most nEnvs
+        super().__init__(env, nEnvs, nSubsteps)
+        nWorkers = multiprocessing.cpu_count() if nWorkers is None else nWorkers
+        nWorkers = max(min(nWorkers, nEnvs), 1)
+
+        dtype = env.model.dtype
+        buffers = allocateBuffers(nEnvs, self.actionSpace.shape[0], self.observationSpace.shape[0], dtype, True)
+        self.setBuffers(viewBuffers(buffers, nEnvs, dtype))
+
+        config = env.getConfig()
+        bounds = np.linspace(0, nEnvs, nWorkers + 1).round().astype(int)
+        self.pipes = []
+        self.processes = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            pipe, pipeWorker = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=runWorker, daemon=True,
+                                              args=(pipeWorker, config, buffers, nEnvs, start, stop, nSubsteps))
+            process.start()
+            pipeWorker.close()
+            self.pipes.append(pipe)
+            self.processes.append(process)
+        self.waiting = False
+        self.wait()
+
+    def send(self, command):
+        for pipe in self.pipes:
+            pipe.send(command)
+        self.waiting = True
+
+    def wait(self):
+        # wait for all the workers to finish their command
+        for pipe in self.pipes:
+            message = pipe.recv()
+            if message is not None:
+                self.close()
+                raise RuntimeError('A worker of the vector env failed:\n' + message)
+        self.waiting = False
+
+    def stepAsync(self, actions):
+        super().stepAsync(actions)
+        self.send('step')
+
+    def stepWait(self):
+        self.wait()
+        return self.observations, self.rewards, self.dones
+
+    def resetAsync(self):
+        self.send('reset')
+
+    def resetWait(self):
+        self.wait()
+        return self.observations
+
+    def close(self):
+        for pipe in self.pipes:
+            try:
+                pipe.send('close')
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join()
+        for pipe in self.pipes:
+            pipe.close()
+        self.pipes = []
+        self.processes = []
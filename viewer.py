@@ -1,11 +1,43 @@
+import time
+import queue
+import threading
 import numpy as np
 import open3d as o3     # open3d 0.10.0
 
 
 class Viewer(object):
-    def __init__(self, env=None):
+    def __init__(self, env=None, recording=None, speed=1.0, nSubsteps=None, threaded=False):
+        # input: env: the env simulated live
+        #        recording: if set, a recorder.Recording replayed instead of simulating, see Env.replay
+        #        speed: target ratio of the simulated time to the wall clock time
+        #        nSubsteps: number of steps simulated per frame, if None, as many as needed to keep up with speed
+        #        threaded: if True, the simulation runs in a background thread and each frame shows its last state,
+        #                  nSubsteps then bounds the number of steps between two published states
         self.env = env
-        self.model = env.model
+        self.model = env.model if env is not None else None
+
+        # ======= live simulation =======
+        self.nSubsteps = nSubsteps
+        self.nSubstepsMax = 1000    # max number of steps per frame, when nSubsteps is None
+        self.threaded = threaded
+        self.thread = None
+        self.running = False
+        self.buffers = None         # two [nv x 3] positions, the simulation writes one while the other is shown
+        self.iFront = 0             # index of the buffer shown
+        self.lock = threading.Lock()
+        self.tasks = queue.Queue()  # changes of the model by the key callbacks, run by the simulation thread
+
+        # ======= replay =======
+        self.recording = recording
+        self.speed = speed
+        self.times = None           # chronological times of the frames of the recording
+        self.tPlay = 0              # simulated time played
+        self.tWall = None           # wall clock time of the last update
+        self.playing = True
+        self.loop = True
+        if recording is not None:
+            self.times = recording.getTimes()
+            self.tPlay = self.times[0]
 
         self.vis = o3.visualization.VisualizerWithKeyCallback()
         self.opt = None
@@ -53,9 +85,13 @@ class Viewer(object):
         self.vis.add_geometry(ground)
 
     def drawMesh(self):
-        self.lines = o3.geometry.LineSet(points=o3.utility.Vector3dVector(self.model.v),
-                                         lines=o3.utility.Vector2iVector(self.model.e))
-        self.lines.colors = o3.utility.Vector3dVector(np.ones([self.model.e.shape[0], 3]))
+        if self.recording is not None:
+            v, e = self.recording.getFrame(0), self.recording.e
+        else:
+            v, e = self.model.v, self.model.e
+        self.lines = o3.geometry.LineSet(points=o3.utility.Vector3dVector(v),
+                                         lines=o3.utility.Vector2iVector(e))
+        self.lines.colors = o3.utility.Vector3dVector(np.ones([e.shape[0], 3]))
         self.vis.add_geometry(self.lines)
 
     def drawAll(self):
@@ -68,41 +104,150 @@ class Viewer(object):
         self.view.set_constant_z_far(10000)
 
     # update
-    def updateMesh(self):
-        for i, v in enumerate(self.model.v):
-            self.lines.points[i] = v
+    def updateMesh(self, vs=None):
+        # input: vs: positions of the vertices, those of the model by default
+        vs = self.model.v if vs is None else vs
+        self.lines.points = o3.utility.Vector3dVector(np.asarray(vs, dtype=np.float64))
         self.vis.update_geometry(self.lines)
 
     def updateAll(self):
         self.updateMesh()
 
     # routine
+    def getNSubsteps(self):
+        # return : number of steps to simulate so that the simulated time follows the wall clock times speed
+        if self.nSubsteps is not None:
+            return self.nSubsteps
+        tWall = time.time()
+        dt = 0 if self.tWall is None else (tWall - self.tWall) * self.speed
+        self.tWall = tWall
+        return int(min(max(np.round(dt / self.model.h), 1), self.nSubstepsMax))
+
+    def simulate(self, nSteps):
+        for i in range(nSteps):
+            action = self.env.getAction()
+            self.env.step(action)
+
     def timerCallback(self, vis):
-        action = self.env.getAction()
-        self.env.step(action)
+        self.simulate(self.getNSubsteps())
         self.updateAll()
 
     def registerAnimationCallback(self):
-        self.vis.register_animation_callback(self.timerCallback)
+        if self.threaded:
+            self.startSimulation()
+            self.vis.register_animation_callback(self.bufferCallback)
+        else:
+            self.vis.register_animation_callback(self.timerCallback)
+
+    # background simulation
+    def startSimulation(self):
+        self.buffers = [np.copy(self.model.v), np.copy(self.model.v)]
+        self.iFront = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.simulationLoop, daemon=True)
+        self.thread.start()
+
+    def stopSimulation(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def simulationLoop(self):
+        # simulate at the target speed and publish the positions after each batch of steps
+        tWall0 = time.time()
+        time0 = self.model.time
+        while self.running:
+            while not self.tasks.empty():
+                self.tasks.get()()
+            nSteps = int((time0 + (time.time() - tWall0) * self.speed - self.model.time) / self.model.h)
+            if nSteps <= 0:
+                time.sleep(0.001)
+                continue
+            self.simulate(min(nSteps, self.nSubsteps or self.nSubstepsMax))
+
+            iBack = 1 - self.iFront
+            np.copyto(self.buffers[iBack], self.model.v)
+            with self.lock:
+                self.iFront = iBack
+
+    def runOnModel(self, task):
+        # run task, a function changing the model, between two steps: in the simulation thread if it runs in the
+        # background, so that the key callbacks never change the arrays of the model in the middle of a step
+        if self.thread is None:
+            task()
+        else:
+            self.tasks.put(task)
+
+    def bufferCallback(self, vis):
+        with self.lock:
+            self.updateMesh(self.buffers[self.iFront])
+
+    def replayCallback(self, vis):
+        # show the last frame recorded before the played time, which advances with the wall clock
+        tWall = time.time()
+        if self.playing and self.tWall is not None:
+            self.tPlay += (tWall - self.tWall) * self.speed
+        self.tWall = tWall
+
+        if self.tPlay > self.times[-1]:
+            self.tPlay = self.times[0] if self.loop else self.times[-1]
+        iFrame = max(np.searchsorted(self.times, self.tPlay, side='right') - 1, 0)
+        self.updateMesh(self.recording.getFrame(iFrame))
+
+    def registerReplayCallback(self):
+        self.vis.register_animation_callback(self.replayCallback)
+
+    def seek(self, dt):
+        self.tPlay = min(max(self.tPlay + dt, self.times[0]), self.times[-1])
+        print('time: {:.3f}'.format(self.tPlay))
 
     # key callbacks
     def keyCallbackActuation(self, vis, action, mod):
         if action:
-            self.model.switch()
-            print('pressure: ', self.model.pressure)
-            pass
+            def switch():
+                self.model.switch()
+                print('pressure: ', self.model.pressure)
+            self.runOnModel(switch)
 
     def keyCallbackPause(self, vis, action, mod):
         if action:
-            self.model.pause = not self.model.pause
-            print('pause: ', self.model.pause)
-            pass
+            def pause():
+                self.model.pause = not self.model.pause
+                print('pause: ', self.model.pause)
+            self.runOnModel(pause)
+
+    def keyCallbackPlay(self, vis, action, mod):
+        if action:
+            self.playing = not self.playing
+            print('playing: ', self.playing)
+
+    def keyCallbackLoop(self, vis, action, mod):
+        if action:
+            self.loop = not self.loop
+            print('loop: ', self.loop)
+
+    def keyCallbackForward(self, vis, action, mod):
+        if action:
+            self.seek((self.times[-1] - self.times[0]) / 20)
+
+    def keyCallbackBackward(self, vis, action, mod):
+        if action:
+            self.seek(-(self.times[-1] - self.times[0]) / 20)
 
     def registerKeyCallback(self):
-        callbacks = {
-            65: self.keyCallbackActuation,   # a
-            80: self.keyCallbackPause,       # p
-        }
+        if self.recording is not None:
+            callbacks = {
+                32: self.keyCallbackPlay,        # space
+                76: self.keyCallbackLoop,        # l
+                262: self.keyCallbackForward,    # right, seek forward by 1/20 of the recording
+                263: self.keyCallbackBackward,   # left
+            }
+        else:
+            callbacks = {
+                65: self.keyCallbackActuation,   # a
+                80: self.keyCallbackPause,       # p
+            }
 
         for code in callbacks:
             self.vis.register_key_action_callback(code, callbacks[code])
@@ -110,4 +255,5 @@ class Viewer(object):
 
     def run(self):
         self.vis.run()
+        self.stopSimulation()
         self.vis.destroy_window()